@@ -20,55 +20,687 @@ Features:
 # ==========================
 # Imports
 # ==========================
-import os, uuid, random, sqlite3
+import os, re, uuid, random, sqlite3, base64, json, queue, threading, hashlib, time, bisect, hmac, logging, gzip, ipaddress, multiprocessing
+from collections import Counter, OrderedDict
 from functools import wraps
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
 
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, jsonify, g, send_from_directory
+    session, flash, jsonify, g, send_from_directory, Response, abort,
+    before_render_template, template_rendered
 )
-from werkzeug.utils import secure_filename
+from markupsafe import Markup
+import click
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import media
+
 # ==========================
 # Configuration
 # ==========================
 BASE_DIR = os.path.dirname(__file__)
-UPLOAD_FOLDER = os.path.join(BASE_DIR, "static", "uploads")
+# A database kept apart from harnect.db (seed, bench, import) can point these at its own folders.
+UPLOAD_FOLDER = os.environ.get("HARNECT_UPLOAD_FOLDER") or os.path.join(BASE_DIR, "static", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Partial chunked uploads; kept outside static/ so they are never served.
+UPLOAD_SESSION_FOLDER = os.environ.get("HARNECT_UPLOAD_SESSION_FOLDER") or os.path.join(BASE_DIR, "upload_sessions")
+os.makedirs(UPLOAD_SESSION_FOLDER, exist_ok=True)
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "mp4", "webm", "ogg", "avi"}
-DATABASE_PATH = os.path.join(BASE_DIR, "harnect.db")
+DATABASE_PATH = os.environ.get("HARNECT_DATABASE") or os.path.join(BASE_DIR, "harnect.db")
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("HARNECT_SECRET_KEY") or os.urandom(24)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB
+app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB per request; larger files use upload sessions
+app.config["UPLOAD_SESSION_FOLDER"] = UPLOAD_SESSION_FOLDER
+app.config["UPLOAD_CHUNK_SIZE"] = 4 * 1024 * 1024       # size the client is told to send
+app.config["UPLOAD_CHUNK_MAX"] = 8 * 1024 * 1024        # largest chunk the server accepts
+app.config["UPLOAD_SESSION_MAX_SIZE"] = 1024 * 1024 * 1024  # 1GB per file
+app.config["UPLOAD_SESSION_TTL"] = timedelta(hours=24)  # idle sessions older than this are purged
 app.config["SESSION_COOKIE_HTTPONLY"] = True
+app.config["FEED_PAGE_SIZE"] = int(os.environ.get("HARNECT_FEED_PAGE_SIZE", 10))
+app.config["FEED_COMMENTS_PER_POST"] = int(os.environ.get("HARNECT_FEED_COMMENTS_PER_POST", 3))
+app.config["COMMENTS_PAGE_SIZE"] = 20
+# Posts are copied into each follower's timeline at write time, except for
+# authors above FANOUT_LIMIT followers: their posts are merged in at read time.
+app.config["FANOUT_LIMIT"] = int(os.environ.get("HARNECT_FANOUT_LIMIT", 5000))
+app.config["TIMELINE_BACKFILL"] = 200  # recent posts copied into a timeline on follow
+app.config["LIVE_COUNTS_ENABLED"] = os.environ.get("HARNECT_LIVE_COUNTS", "1") == "1"
+app.config["LIVE_COUNTS_HEARTBEAT"] = 20  # seconds between SSE keep-alives
+app.config["COUNTS_BATCH_LIMIT"] = 100
+app.config["SEARCH_PAGE_SIZE"] = 20
+app.config["SEARCH_RECENCY_WEIGHT"] = 2.0     # bm25 bonus for a brand-new post, decays with age in days
+app.config["SEARCH_POPULARITY_WEIGHT"] = 2.0  # bm25 bonus as likes/followers saturate
+app.config["BLOB_RELEASE_GRACE"] = timedelta(minutes=10)  # unreferenced files linger this long before a sweep deletes them
+app.config["USE_X_SENDFILE"] = os.environ.get("HARNECT_X_SENDFILE") == "1"
+app.config["MEDIA_WORKERS"] = int(os.environ.get("HARNECT_MEDIA_WORKERS", 2))
+app.config["VIDEO_WORKERS"] = int(os.environ.get("HARNECT_VIDEO_WORKERS", 1))
+# "inline": each app process runs a job dispatcher; "external": only `flask video-worker` does.
+app.config["VIDEO_WORKER_MODE"] = os.environ.get("HARNECT_VIDEO_WORKER_MODE", "inline")
+app.config["VIDEO_JOB_MAX_ATTEMPTS"] = 3
+app.config["VIDEO_JOB_STALE_AFTER"] = timedelta(hours=1)  # a running job older than this is presumed dead
+app.config["DB_BUSY_TIMEOUT_MS"] = int(os.environ.get("HARNECT_DB_BUSY_TIMEOUT_MS", 5000))
+app.config["DB_STATEMENT_CACHE"] = 256
+app.config["DB_PRAGMAS"] = {
+    "journal_mode": "WAL",     # readers no longer block behind the writer
+    "synchronous": "NORMAL",   # durable at checkpoints; safe with WAL
+    "temp_store": "MEMORY",
+    "cache_size": -16000,      # ~16MB page cache per connection
+    "mmap_size": 128 * 1024 * 1024,
+}
+# Route every write through one writer thread that groups concurrent small
+# transactions into a single commit. Set HARNECT_DB_WRITER=0 to write inline.
+app.config["DB_WRITER_ENABLED"] = os.environ.get("HARNECT_DB_WRITER", "1") == "1"
+app.config["DB_WRITE_BATCH_MAX"] = 64
+app.config["DB_WRITE_BATCH_WINDOW_MS"] = 2
+app.config["DB_LOCK_WAIT_WARN_MS"] = 250
+app.config["DB_WRITE_TIMEOUT"] = 30  # seconds write() waits for the writer thread before giving up
+# "memory": per-process LRU; "sqlite": shared on-disk cache for multi-process deployments; "none" disables.
+app.config["CACHE_BACKEND"] = os.environ.get("HARNECT_CACHE", "memory")
+app.config["CACHE_PATH"] = os.environ.get("HARNECT_CACHE_PATH", os.path.join(BASE_DIR, "harnect_cache.db"))
+app.config["CACHE_MAX_ENTRIES"] = 5000
+app.config["CACHE_TTL"] = 300          # seconds; versions make entries stale long before this
+app.config["SEARCH_CACHE_TTL"] = 60    # search ranking also drifts with likes/follows, which do not bump versions
+app.config["STORY_TTL"] = timedelta(hours=24)
+app.config["GUEST_TTL"] = timedelta(days=3)  # guest accounts are purged this long after creation
+# "inline": each app process runs the maintenance scheduler; "external": only `flask maintenance` does.
+app.config["MAINTENANCE_MODE"] = os.environ.get("HARNECT_MAINTENANCE_MODE", "inline")
+app.config["MAINTENANCE_INTERVAL"] = timedelta(minutes=10)
+app.config["MAINTENANCE_BATCH"] = 100        # rows per write transaction
+app.config["MAINTENANCE_MAX_BATCHES"] = 50   # per job per run; the rest waits for the next run
+app.config["MAINTENANCE_PAUSE"] = 0.05       # seconds between batches, so request writes get the lock
+app.config["MAINTENANCE_HISTORY"] = timedelta(days=30)
+app.config["NOTIFICATIONS_PAGE_SIZE"] = 30
+app.config["NOTIFICATION_TTL"] = timedelta(days=60)  # read notifications older than this are pruned
+app.config["METRICS_ENABLED"] = os.environ.get("HARNECT_METRICS", "1") == "1"
+# When set, /metrics requires "Authorization: Bearer <token>"; otherwise only
+# direct loopback requests (or any request in debug mode) may read it.
+app.config["METRICS_TOKEN"] = os.environ.get("HARNECT_METRICS_TOKEN")
+app.config["SLOW_QUERY_MS"] = int(os.environ.get("HARNECT_SLOW_QUERY_MS", 100))
+app.config["SLOW_QUERY_LOG"] = os.environ.get("HARNECT_SLOW_QUERY_LOG")  # file path; by default slow queries go to the app log
+app.config["SERVER_TIMING"] = os.environ.get("HARNECT_SERVER_TIMING") == "1"  # always on in debug mode
+app.config["API_MAX_PAGE_SIZE"] = 50
+app.config["COMPRESS_MIN_SIZE"] = 1024  # bytes; smaller bodies are not worth the CPU
+app.config["COMPRESS_LEVEL"] = 6        # gzip level; brotli (if installed) uses quality 5
+app.config["COMPRESS_MIMETYPES"] = {"text/html", "application/json", "text/css", "application/javascript", "text/plain"}
 
 # ==========================
 # Database Helpers
 # ==========================
+def connect_db(**kwargs):
+    """Open a tuned connection: WAL, busy_timeout, pragmas and a statement cache."""
+    if app.config["METRICS_ENABLED"]:
+        kwargs.setdefault("factory", InstrumentedConnection)
+    db = sqlite3.connect(DATABASE_PATH, timeout=app.config["DB_BUSY_TIMEOUT_MS"] / 1000,
+                         cached_statements=app.config["DB_STATEMENT_CACHE"], **kwargs)
+    db.row_factory = sqlite3.Row
+    db.execute(f"PRAGMA busy_timeout={int(app.config['DB_BUSY_TIMEOUT_MS'])}")
+    for name, value in app.config["DB_PRAGMAS"].items():
+        db.execute(f"PRAGMA {name}={value}")
+    return db
+
+_local = threading.local()
+
 def get_db():
-    """Return SQLite DB connection for current context."""
-    db = getattr(g, "db", None)
+    """Return this thread's reusable read connection.
+
+    Writes go through write(); the request connection only reads, so it
+    never holds the write lock.
+    """
+    db = getattr(_local, "db", None)
     if db is None:
-        db = g.db = sqlite3.connect(DATABASE_PATH)
-        db.row_factory = sqlite3.Row
+        db = _local.db = connect_db()
     return db
 
 @app.teardown_appcontext
 def close_db(e=None):
-    db = getattr(g, "db", None)
-    if db:
-        db.close()
+    # Connections are kept per thread; just make sure nothing leaks into the next request.
+    db = getattr(_local, "db", None)
+    if db is not None and db.in_transaction:
+        db.rollback()
 
-def init_db():
-    """Initialize DB tables if missing."""
-    db = sqlite3.connect(DATABASE_PATH)
-    c = db.cursor()
+class DbWriter:
+    """Serialize all writes through one thread and one connection.
+
+    Callables queued within DB_WRITE_BATCH_WINDOW_MS of each other (up to
+    DB_WRITE_BATCH_MAX) share one BEGIN IMMEDIATE ... COMMIT, so a burst of
+    likes costs one fsync instead of one each. Every callable runs in its
+    own SAVEPOINT, so a failing write is rolled back without touching the
+    rest of the batch. Callables must not commit or roll back themselves.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "writes": 0, "errors": 0, "queue_wait_ms": 0.0,
+                      "lock_wait_ms": 0.0, "lock_wait_max_ms": 0.0}
+
+    def submit(self, fn):
+        fut = Future()
+        self._queue.put((fn, fut, time.monotonic()))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+                self._thread.start()
+        return fut
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + app.config["DB_WRITE_BATCH_WINDOW_MS"] / 1000
+        while len(batch) < app.config["DB_WRITE_BATCH_MAX"]:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        db = None
+        while True:
+            batch = [(fn, fut, queued) for fn, fut, queued in self._next_batch() if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                if db is None:
+                    db = connect_db(isolation_level=None, check_same_thread=False)
+                results = self._run_batch(db, batch)
+            except Exception as e:
+                # BEGIN, a ROLLBACK TO or the COMMIT failed: nothing in the batch
+                # is known to have committed, so fail all of it and carry on with
+                # a fresh connection rather than let the thread die.
+                app.logger.exception("DB writer batch failed")
+                results = [(fut, None, e) for _, fut, _ in batch]
+                db = self._discard(db)
+            self.stats["batches"] += 1
+            self.stats["writes"] += len(batch)
+            for fut, value, error in results:
+                if error is None:
+                    fut.set_result(value)
+                else:
+                    self.stats["errors"] += 1
+                    fut.set_exception(error)
+
+    def _run_batch(self, db, batch):
+        started = time.monotonic()
+        db.execute("BEGIN IMMEDIATE")
+        record_lock_wait(self.stats, (time.monotonic() - started) * 1000)
+        results = []
+        for fn, fut, queued in batch:
+            self.stats["queue_wait_ms"] += (started - queued) * 1000
+            db.execute("SAVEPOINT write")
+            try:
+                results.append((fut, fn(db), None))
+                db.execute("RELEASE write")
+            except Exception as e:
+                db.execute("ROLLBACK TO write")
+                db.execute("RELEASE write")
+                results.append((fut, None, e))
+        db.execute("COMMIT")
+        return results
+
+    @staticmethod
+    def _discard(db):
+        if db is not None:
+            try:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                db.close()
+            except Exception:
+                pass
+        return None
+
+writer = DbWriter()
+
+def record_lock_wait(stats, waited_ms):
+    stats["lock_wait_ms"] += waited_ms
+    stats["lock_wait_max_ms"] = max(stats["lock_wait_max_ms"], waited_ms)
+    if waited_ms > app.config["DB_LOCK_WAIT_WARN_MS"]:
+        app.logger.warning("Waited %.0f ms for the SQLite write lock", waited_ms)
+
+_inline_stats = {"batches": 0, "writes": 0, "errors": 0, "queue_wait_ms": 0.0, "lock_wait_ms": 0.0, "lock_wait_max_ms": 0.0}
+
+def write(fn):
+    """Run fn(db) in a write transaction and return its result.
+
+    With the writer enabled this blocks until the batch containing fn has
+    committed, or raises TimeoutError after DB_WRITE_TIMEOUT seconds;
+    otherwise fn runs on a per-thread connection right here.
+    """
+    if app.config["DB_WRITER_ENABLED"]:
+        fut = writer.submit(fn)
+        try:
+            return fut.result(timeout=app.config["DB_WRITE_TIMEOUT"])
+        except TimeoutError:
+            fut.cancel()  # still queued: it will be skipped; already running: it may yet commit
+            raise
+    db = getattr(_local, "write_db", None)
+    if db is None:
+        db = _local.write_db = connect_db(isolation_level=None)
+    started = time.monotonic()
+    db.execute("BEGIN IMMEDIATE")
+    record_lock_wait(_inline_stats, (time.monotonic() - started) * 1000)
+    try:
+        result = fn(db)
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        _inline_stats["errors"] += 1
+        raise
+    _inline_stats["writes"] += 1
+    _inline_stats["batches"] += 1
+    return result
+
+def db_stats():
+    """Write-path counters (batches, lock and queue wait) for this process."""
+    return dict(writer.stats if app.config["DB_WRITER_ENABLED"] else _inline_stats)
+
+# ==========================
+# Caching
+# ==========================
+# Entries are keyed by the current value of the version counters they depend
+# on (cache_versions table). Writes bump those counters inside their own
+# transaction, so a changed row can never be served from the cache; old
+# entries simply stop being looked up and age out of the LRU/TTL.
+_MISS = object()
+
+class MemoryCache:
+    """Thread-safe in-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries, self.ttl = max_entries, ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_many(self, keys):
+        now, found = time.monotonic(), {}
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None or item[1] < now:
+                    if item is not None: del self._data[key]
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(key)
+                self.hits += 1
+                found[key] = item[0]
+        return found
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class SqliteCache:
+    """Cache shared by every process on the host, kept in its own SQLite file.
+
+    Values must be JSON-serialisable. The file is disposable, so it is
+    written without fsync; oldest-expiring entries are trimmed past
+    max_entries.
+    """
+
+    def __init__(self, path, max_entries, ttl):
+        self.path, self.max_entries, self.ttl = path, max_entries, ttl
+        self._local = threading.local()
+        self._sets = 0
+        self.hits = self.misses = 0
+        self._conn().execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL) WITHOUT ROWID")
+        self._conn().execute("CREATE INDEX IF NOT EXISTS ix_cache_expires ON cache(expires)")
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+        return db
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        rows = self._conn().execute(f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(keys))}) AND expires>=?",
+                                    (*keys, time.time())).fetchall()
+        self.hits += len(rows); self.misses += len(keys) - len(rows)
+        return {k: json.loads(v) for k, v in rows}
+
+    def set(self, key, value, ttl=None):
+        try:
+            db = self._conn()
+            db.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?,?,?)", (key, json.dumps(value), time.time() + (ttl or self.ttl)))
+            self._sets += 1
+            if self._sets % 500 == 0:
+                db.execute("DELETE FROM cache WHERE expires<?", (time.time(),))
+                db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        except sqlite3.OperationalError:
+            pass  # busy: skipping a cache fill is always safe
+
+    def clear(self):
+        self._conn().execute("DELETE FROM cache")
+
+class NullCache:
+    hits = misses = 0
+    def get_many(self, keys): return {}
+    def set(self, key, value, ttl=None): pass
+    def clear(self): pass
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            backend, size, ttl = app.config["CACHE_BACKEND"], app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_TTL"]
+            _cache = (SqliteCache(app.config["CACHE_PATH"], size, ttl) if backend == "sqlite"
+                      else MemoryCache(size, ttl) if backend == "memory" else NullCache())
+        return _cache
+
+def bump(db, *names):
+    """Invalidate everything cached against these version names. Call inside write().
+
+    Versions are random rather than incrementing, so a restored or reset
+    database can never bring back a version an old cache entry was keyed on.
+    """
+    db.executemany("""INSERT INTO cache_versions (name, version) VALUES (?, random())
+                      ON CONFLICT(name) DO UPDATE SET version=random()""", [(n,) for n in dict.fromkeys(names)])
+
+def cache_versions(names):
+    names = list(dict.fromkeys(names))
+    if not names:
+        return {}
+    rows = get_db().execute(f"SELECT name, version FROM cache_versions WHERE name IN ({','.join('?' * len(names))})", names).fetchall()
+    found = dict(rows)
+    return {n: found.get(n, 0) for n in names}
+
+def versioned_key(key, depends, versions):
+    return key + "|" + ",".join(f"{d}={versions[d]}" for d in depends)
+
+def cached(key, depends, build, ttl=None):
+    """Return build(), memoised under `key` and the current versions of `depends`."""
+    full = versioned_key(key, depends, cache_versions(depends))
+    value = get_cache().get_many([full]).get(full, _MISS)
+    if value is _MISS:
+        value = build()
+        get_cache().set(full, value, ttl)
+    return value
+
+# ==========================
+# Metrics
+# ==========================
+# Per-endpoint latency and status counts, per-statement SQL timings, template
+# render times and the writer/cache counters, served at /metrics in the
+# Prometheus text format. Numbers are per process: scrape each one.
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)  # statements per request; a high tail means an N+1 loop
+SQL_VERBS = {"SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH"}
+
+class Metrics:
+    """Thread-safe counters and histograms keyed by (name, labels)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels=(), buckets=TIME_BUCKETS):
+        with self._lock:
+            h = self._histograms.get((name, labels))
+            if h is None:
+                h = self._histograms[(name, labels)] = [buckets, [0] * len(buckets), 0.0, 0]
+            i = bisect.bisect_left(buckets, value)
+            if i < len(buckets):
+                h[1][i] += 1
+            h[2] += value
+            h[3] += 1
+
+    def render(self, extra=()):
+        """Prometheus text exposition; `extra` is (name, type, labels, value) for sampled values."""
+        with self._lock:
+            samples = [(n, "counter", l, v) for (n, l), v in self._counters.items()]
+            histograms = [(n, l, list(h[1]), h) for (n, l), h in self._histograms.items()]
+        lines, typed = [], set()
+        for name, kind, labels, value in sorted([*samples, *extra], key=lambda s: (s[0], s[2])):
+            if name not in typed:
+                typed.add(name); lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{prom_labels(labels)} {value}")
+        for name, labels, counts, (buckets, _, total, count) in sorted(histograms, key=lambda h: (h[0], h[1])):
+            if name not in typed:
+                typed.add(name); lines.append(f"# TYPE {name} histogram")
+            running = 0
+            for le, n in zip(buckets, counts):
+                running += n
+                lines.append(f"{name}_bucket{prom_labels(labels, le=le)} {running}")
+            lines.append(f"{name}_bucket{prom_labels(labels, le='+Inf')} {count}")
+            lines.append(f"{name}_sum{prom_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{prom_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def prom_labels(labels, **extra):
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+metrics = Metrics()
+sql_log = app.logger.getChild("sql")
+if app.config["SLOW_QUERY_LOG"]:
+    _slow_handler = logging.FileHandler(app.config["SLOW_QUERY_LOG"])
+    _slow_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    sql_log.addHandler(_slow_handler)
+    sql_log.propagate = False
+
+def redact(params):
+    """Bound parameters as their types only: values hold usernames, hashes and post text."""
+    if params is None:
+        return "[executemany]"
+    if isinstance(params, dict):
+        return {k: type(v).__name__ for k, v in params.items()}
+    return [type(v).__name__ for v in params]
+
+def record_query(sql, params, seconds):
+    verb = sql.lstrip()[:7].split(None, 1)[0].upper() if sql.strip() else ""
+    metrics.observe("harnect_sql_duration_seconds", seconds, (("statement", verb if verb in SQL_VERBS else "OTHER"),))
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace["queries"] += 1
+        trace["sql"] += seconds
+    if seconds * 1000 >= app.config["SLOW_QUERY_MS"]:
+        sql_log.warning("Slow query (%.1f ms): %s params=%s", seconds * 1000, " ".join(sql.split()), redact(params))
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that times a statement from execute() through its last fetch.
+
+    A statement is recorded when the cursor runs the next one or is
+    released, so the time spent stepping through rows is included.
+    """
+    _statement = None
+
+    def _timed(self, call, *args):
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            if self._statement:
+                self._statement[2] += time.perf_counter() - started
+
+    def _finish(self):
+        stmt, self._statement = self._statement, None
+        if stmt:
+            record_query(*stmt)
+
+    def execute(self, sql, params=()):
+        self._finish()
+        self._statement = [sql, params, 0.0]
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq):
+        self._finish()
+        self._statement = [sql, None, 0.0]
+        return self._timed(super().executemany, sql, seq)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass  # interpreter shutdown
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including db.execute shortcuts) are TimedCursors."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+@app.before_request
+def start_request_trace():
+    if app.config["METRICS_ENABLED"]:
+        g.request_started = time.perf_counter()
+        _local.trace = {"queries": 0, "sql": 0.0, "templates": 0.0}
+
+@app.after_request
+def record_request(resp):
+    started, trace = g.pop("request_started", None), getattr(_local, "trace", None)
+    if started is None or trace is None:
+        return resp
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    metrics.observe("harnect_request_duration_seconds", elapsed, (("endpoint", endpoint), ("method", request.method)))
+    metrics.observe("harnect_request_queries", trace["queries"], (("endpoint", endpoint),), QUERY_BUCKETS)
+    metrics.inc("harnect_requests_total", (("endpoint", endpoint), ("method", request.method), ("status", resp.status_code)))
+    if app.debug or app.config["SERVER_TIMING"]:
+        resp.headers.add("Server-Timing", f'db;dur={trace["sql"] * 1000:.1f};desc="{trace["queries"]} queries", '
+                                          f'tpl;dur={trace["templates"] * 1000:.1f}, total;dur={elapsed * 1000:.1f}')
+    return resp
+
+@app.teardown_request
+def end_request_trace(e=None):
+    _local.trace = None
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault("template_starts", []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_template(sender, template, context, **extra):
+    starts = g.get("template_starts")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    metrics.observe("harnect_template_render_seconds", elapsed, (("template", template.name),))
+    trace = getattr(_local, "trace", None)
+    if trace is not None and not starts:
+        trace["templates"] += elapsed
+
+def sampled_metrics():
+    """Writer and cache counters kept elsewhere, read at scrape time."""
+    stats, cache = db_stats(), get_cache()
+    backend = (("backend", app.config["CACHE_BACKEND"]),)
+    return [
+        ("harnect_db_write_batches_total", "counter", (), stats["batches"]),
+        ("harnect_db_writes_total", "counter", (), stats["writes"]),
+        ("harnect_db_write_errors_total", "counter", (), stats["errors"]),
+        ("harnect_db_queue_wait_seconds_total", "counter", (), round(stats["queue_wait_ms"] / 1000, 6)),
+        ("harnect_db_lock_wait_seconds_total", "counter", (), round(stats["lock_wait_ms"] / 1000, 6)),
+        ("harnect_db_lock_wait_max_seconds", "gauge", (), round(stats["lock_wait_max_ms"] / 1000, 6)),
+        ("harnect_db_write_queue_depth", "gauge", (), writer._queue.qsize()),
+        ("harnect_cache_hits_total", "counter", backend, cache.hits),
+        ("harnect_cache_misses_total", "counter", backend, cache.misses),
+    ]
+
+def is_local_request():
+    """A direct loopback connection; anything relayed by a proxy carries X-Forwarded-For."""
+    try:
+        loopback = ipaddress.ip_address(request.remote_addr or "").is_loopback
+    except ValueError:
+        return False
+    return loopback and "X-Forwarded-For" not in request.headers
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if not app.config["METRICS_ENABLED"]:
+        abort(404)
+    token = app.config["METRICS_TOKEN"]
+    if token:
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            abort(401)
+    elif not (app.debug or is_local_request()):
+        abort(403)
+    return Response(metrics.render(sampled_metrics()), mimetype="text/plain; version=0.0.4")
 
+# ==========================
+# Response Compression
+# ==========================
+# Dynamic HTML and JSON above COMPRESS_MIN_SIZE are brotli- or gzip-encoded,
+# whichever the client prefers. Files from send_file and streamed responses
+# (SSE) are left alone. brotli is optional: without it only gzip is offered.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+@app.after_request
+def compress_response(resp):
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code < 200 or resp.status_code in (204, 206, 304)
+            or "Content-Encoding" in resp.headers or resp.mimetype not in app.config["COMPRESS_MIMETYPES"]):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    accepted = request.accept_encodings
+    encoding = "br" if brotli and accepted["br"] and accepted["br"] >= accepted["gzip"] else "gzip" if accepted["gzip"] else None
+    data = resp.get_data()
+    if not encoding or len(data) < app.config["COMPRESS_MIN_SIZE"]:
+        return resp
+    if encoding == "br":
+        data = brotli.compress(data, quality=5)
+    else:
+        data = gzip.compress(data, compresslevel=app.config["COMPRESS_LEVEL"], mtime=0)
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = encoding
+    return resp
+
+# ==========================
+# Schema Migrations
+# ==========================
+# Each step runs once, in its own transaction, and bumps PRAGMA user_version.
+# Append new steps to MIGRATIONS; never edit one that has shipped.
+
+def _m001_base_tables(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS users (
         username TEXT PRIMARY KEY,
@@ -126,9 +758,328 @@ def init_db():
         created_at TEXT
     )""")
 
-    db.commit()
+def _m002_indexes(c):
+    # Older databases may hold duplicate likes/follows; keep the first of each.
+    c.execute("DELETE FROM likes WHERE id NOT IN (SELECT MIN(id) FROM likes GROUP BY post_id, username)")
+    c.execute("DELETE FROM followers WHERE id NOT IN (SELECT MIN(id) FROM followers GROUP BY username, follower)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_likes_post_user ON likes(post_id, username)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_likes_user ON likes(username)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_followers_user_follower ON followers(username, follower)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_followers_follower ON followers(follower, username)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_posts_type_created ON posts(type, created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_posts_user_created ON posts(username, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_comments_post_created ON comments(post_id, created_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_feedback_created ON feedback(created_at)")
+
+def _m003_counters(c):
+    c.execute("ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE users ADD COLUMN followers_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE users ADD COLUMN following_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE users ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0")
+    backfill_counters(c)
+
+def _m004_search(c):
+    # Trigram FTS5 indexes over users and posts (external content, kept in sync by triggers).
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(username, bio, content='users', content_rowid='rowid', tokenize='trigram')")
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(caption, username, content='posts', content_rowid='id', tokenize='trigram')")
+    for table, key, cols in (("users", "rowid", ("username", "bio")), ("posts", "id", ("caption", "username"))):
+        names = ", ".join(cols)
+        new = ", ".join(f"new.{col}" for col in cols)
+        old = ", ".join(f"old.{col}" for col in cols)
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts(rowid, {names}) VALUES (new.{key}, {new});
+        END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts({table}_fts, rowid, {names}) VALUES ('delete', old.{key}, {old});
+        END""")
+        c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF {names} ON {table} BEGIN
+            INSERT INTO {table}_fts({table}_fts, rowid, {names}) VALUES ('delete', old.{key}, {old});
+            INSERT INTO {table}_fts(rowid, {names}) VALUES (new.{key}, {new});
+        END""")
+        c.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+def _m005_media(c):
+    # One row per stored upload; derivative widths are recorded once they exist on disk.
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS media (
+        filename TEXT PRIMARY KEY,
+        kind TEXT,
+        status TEXT DEFAULT 'pending',
+        width INTEGER,
+        height INTEGER,
+        variants TEXT DEFAULT '',
+        created_at TEXT
+    )""")
+
+def _m006_video_jobs(c):
+    c.execute("ALTER TABLE media ADD COLUMN poster TEXT")
+    c.execute("ALTER TABLE media ADD COLUMN playback TEXT")
+    c.execute("ALTER TABLE media ADD COLUMN duration REAL")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT,
+        filename TEXT,
+        status TEXT DEFAULT 'queued',
+        attempts INTEGER DEFAULT 0,
+        error TEXT,
+        created_at TEXT,
+        updated_at TEXT
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs(status, id)")
+
+def _m007_blobs(c):
+    # Reference counts for stored upload files. Existing uuid-named files are
+    # adopted as-is (no hash); new uploads are named after their SHA-256.
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        filename TEXT PRIMARY KEY,
+        sha256 TEXT,
+        size INTEGER,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT,
+        released_at TEXT
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_blobs_released ON blobs(refcount, released_at)")
+    c.execute("""
+        INSERT OR IGNORE INTO blobs (filename, refcount, created_at)
+        SELECT filename, COUNT(*), datetime('now') FROM (
+            SELECT filename FROM posts WHERE filename IS NOT NULL
+            UNION ALL SELECT profile_pic FROM users WHERE profile_pic IS NOT NULL AND profile_pic!='user.png'
+        ) GROUP BY filename
+    """)
+
+def _m008_upload_sessions(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        ext TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        received INTEGER NOT NULL DEFAULT 0,
+        caption TEXT,
+        type TEXT NOT NULL DEFAULT 'post',
+        created_at TEXT,
+        updated_at TEXT
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_upload_sessions_updated ON upload_sessions(updated_at)")
+
+def _m009_timeline(c):
+    # Materialised home feed: one row per (reader, post), newest-first per reader.
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS timeline (
+        owner TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        post_id INTEGER NOT NULL,
+        author TEXT NOT NULL,
+        PRIMARY KEY (owner, created_at, post_id)
+    ) WITHOUT ROWID""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_timeline_post ON timeline(post_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_timeline_owner_author ON timeline(owner, author)")
+    # fanout=0 marks posts that were not copied to followers and must be merged in at read time.
+    c.execute("ALTER TABLE posts ADD COLUMN fanout INTEGER NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_posts_pull ON posts(username, created_at, id) WHERE type='post' AND fanout=0")
+    c.execute("UPDATE posts SET fanout=1 WHERE username IN (SELECT username FROM users WHERE followers_count<=?)", (app.config["FANOUT_LIMIT"],))
+    c.execute("""
+        WITH recent AS (
+            SELECT id, username, created_at,
+                   ROW_NUMBER() OVER (PARTITION BY username ORDER BY created_at DESC, id DESC) AS rn
+            FROM posts WHERE type='post'
+        )
+        INSERT OR IGNORE INTO timeline (owner, created_at, post_id, author)
+        SELECT r.username, r.created_at, r.id, r.username FROM recent r
+        UNION ALL
+        SELECT f.follower, r.created_at, r.id, r.username FROM recent r
+        JOIN followers f ON f.username=r.username
+        JOIN posts p ON p.id=r.id AND p.fanout=1
+        WHERE r.rn<=?
+    """, (app.config["TIMELINE_BACKFILL"],))
+
+def _m010_maintenance(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS maintenance_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job TEXT NOT NULL,
+        started_at TEXT NOT NULL,
+        duration_ms REAL,
+        processed INTEGER NOT NULL DEFAULT 0,
+        batches INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'running',
+        error TEXT
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_maintenance_runs_started ON maintenance_runs(started_at)")
+    # Finding a purged guest's comments on other people's posts.
+    c.execute("CREATE INDEX IF NOT EXISTS ix_comments_user ON comments(username)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_users_guest_created ON users(guest, created_at)")
+
+def _m011_cache_versions(c):
+    c.execute("CREATE TABLE IF NOT EXISTS cache_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL) WITHOUT ROWID")
+    # bump_media() maps a processed file back to the posts and profiles showing it.
+    c.execute("CREATE INDEX IF NOT EXISTS ix_posts_filename ON posts(filename)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_users_profile_pic ON users(profile_pic)")
+
+def _m012_comment_client_keys(c):
+    # Comments replayed from the service worker's offline queue carry a
+    # client-generated key, so a retry after a lost response is a no-op.
+    if "client_key" not in {r[1] for r in c.execute("PRAGMA table_info(comments)")}:
+        c.execute("ALTER TABLE comments ADD COLUMN client_key TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_comments_client_key ON comments(username, client_key) WHERE client_key IS NOT NULL")
+
+def _m013_notifications(c):
+    # One row per (recipient, kind, post) while unread; further likes/comments/
+    # follows fold into it ("N people liked your post"), with the distinct
+    # actors kept in notification_actors.
+    c.execute("""CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY,
+        recipient TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        post_id INTEGER NOT NULL DEFAULT 0,
+        actor TEXT NOT NULL,
+        actor_count INTEGER NOT NULL DEFAULT 1,
+        preview TEXT,
+        read INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )""")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_notifications_open ON notifications(recipient, kind, post_id) WHERE read=0")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_notifications_recipient ON notifications(recipient, updated_at, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_notifications_post ON notifications(post_id) WHERE post_id>0")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_notifications_read_updated ON notifications(read, updated_at)")
+    c.execute("""CREATE TABLE IF NOT EXISTS notification_actors (
+        notification_id INTEGER NOT NULL, actor TEXT NOT NULL, PRIMARY KEY (notification_id, actor)
+    ) WITHOUT ROWID""")
+    c.execute("CREATE INDEX IF NOT EXISTS ix_notification_actors_actor ON notification_actors(actor)")
+    if "unread_notifications" not in {r[1] for r in c.execute("PRAGMA table_info(users)")}:
+        c.execute("ALTER TABLE users ADD COLUMN unread_notifications INTEGER NOT NULL DEFAULT 0")
+
+def _m014_username_nocase(c):
+    # Short searches and autocomplete are case-insensitive prefix ranges on this index.
+    c.execute("CREATE INDEX IF NOT EXISTS ix_users_username_nocase ON users(username COLLATE NOCASE)")
+
+MIGRATIONS = [
+    (1, "base tables", _m001_base_tables),
+    (2, "indexes and unique likes/follows", _m002_indexes),
+    (3, "denormalized counters", _m003_counters),
+    (4, "full-text search", _m004_search),
+    (5, "media derivatives", _m005_media),
+    (6, "video jobs", _m006_video_jobs),
+    (7, "content-addressed uploads", _m007_blobs),
+    (8, "resumable upload sessions", _m008_upload_sessions),
+    (9, "home timeline", _m009_timeline),
+    (10, "maintenance runs", _m010_maintenance),
+    (11, "cache versions", _m011_cache_versions),
+    (12, "comment client keys", _m012_comment_client_keys),
+    (13, "notifications", _m013_notifications),
+    (14, "case-insensitive username index", _m014_username_nocase),
+]
+
+def backfill_counters(c):
+    """Recompute every denormalized counter from the underlying rows."""
+    c.execute("""
+        UPDATE posts SET
+            like_count=(SELECT COUNT(*) FROM likes l WHERE l.post_id=posts.id),
+            comment_count=(SELECT COUNT(*) FROM comments m WHERE m.post_id=posts.id)
+    """)
+    c.execute("""
+        UPDATE users SET
+            followers_count=(SELECT COUNT(*) FROM followers f WHERE f.username=users.username),
+            following_count=(SELECT COUNT(*) FROM followers f WHERE f.follower=users.username),
+            post_count=(SELECT COUNT(*) FROM posts p WHERE p.username=users.username AND p.type='post')
+    """)
+
+def rebuild_timelines(c):
+    """Rebuild every home timeline (and each post's fanout flag) from posts and followers."""
+    c.execute("DELETE FROM timeline")
+    c.execute("""UPDATE posts SET fanout=(SELECT u.followers_count<=? FROM users u WHERE u.username=posts.username)
+                 WHERE type='post'""", (app.config["FANOUT_LIMIT"],))
+    c.execute("""
+        WITH recent AS (
+            SELECT id, username, created_at, fanout,
+                   ROW_NUMBER() OVER (PARTITION BY username ORDER BY created_at DESC, id DESC) AS rn
+            FROM posts WHERE type='post'
+        )
+        INSERT OR IGNORE INTO timeline (owner, created_at, post_id, author)
+        SELECT username, created_at, id, username FROM recent
+        UNION ALL
+        SELECT f.follower, r.created_at, r.id, r.username FROM recent r
+        JOIN followers f ON f.username=r.username
+        WHERE r.fanout=1 AND r.rn<=?
+    """, (app.config["TIMELINE_BACKFILL"],))
+
+def rebuild_blob_refcounts(c):
+    """Recount blob references from posts and profile pictures, e.g. after a bulk import.
+
+    Files nothing refers to any more are marked released, so the blob sweep
+    deletes them once BLOB_RELEASE_GRACE has passed.
+    """
+    now = datetime.utcnow().isoformat()
+    c.execute("UPDATE blobs SET refcount=0, released_at=COALESCE(released_at, ?)", (now,))
+    c.execute("""
+        INSERT INTO blobs (filename, sha256, refcount, created_at)
+        SELECT filename,
+               CASE WHEN instr(filename, '.')=65 AND substr(filename, 1, 64) NOT GLOB '*[^0-9a-f]*' THEN substr(filename, 1, 64) END,
+               COUNT(*), ?
+        FROM (SELECT filename FROM posts WHERE filename IS NOT NULL
+              UNION ALL SELECT profile_pic FROM users WHERE profile_pic IS NOT NULL AND profile_pic!='user.png')
+        WHERE true GROUP BY filename
+        ON CONFLICT(filename) DO UPDATE SET refcount=excluded.refcount, released_at=NULL
+    """, (now,))
+
+def migrate(db):
+    """Apply pending MIGRATIONS; returns the list of versions applied."""
+    applied = []
+    current = db.execute("PRAGMA user_version").fetchone()[0]
+    for version, name, step in MIGRATIONS:
+        if version <= current:
+            continue
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            step(db)
+            db.execute(f"PRAGMA user_version={version}")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        applied.append((version, name))
+    return applied
+
+def init_db():
+    """Bring the DB schema up to date."""
+    db = connect_db(isolation_level=None)
+    try:
+        migrate(db)
+    finally:
+        db.close()
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending schema migrations."""
+    db = connect_db(isolation_level=None)
+    applied = migrate(db)
+    for version, name in applied:
+        print(f"Applied migration {version}: {name}")
+    print(f"Schema at version {db.execute('PRAGMA user_version').fetchone()[0]}")
     db.close()
 
+@app.cli.command("backfill-counters")
+def backfill_counters_command():
+    """Recount likes, comments, follows and posts into the counter columns."""
+    write(backfill_counters)
+    print("Counters backfilled.")
+
+@app.cli.command("rebuild-timelines")
+def rebuild_timelines_command():
+    """Recompute every home timeline, e.g. after bulk-loading posts or follows."""
+    write(rebuild_timelines)
+    print("Timelines rebuilt.")
+
+@app.cli.command("rebuild-blob-refcounts")
+def rebuild_blob_refcounts_command():
+    """Recount which uploaded files are still referenced by posts or profiles."""
+    write(rebuild_blob_refcounts)
+    print("Blob reference counts rebuilt.")
+
 # Initialize DB
 init_db()
 
@@ -138,13 +1089,158 @@ init_db()
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def safe_save_file(file, folder=None):
-    if folder is None:
-        folder = app.config["UPLOAD_FOLDER"]
+def spool_upload(stream, folder=None, chunk_size=1024 * 1024):
+    """Copy an upload stream to a temp file in the upload folder, hashing as it goes.
+
+    Returns (tmp_path, sha256_hex, size).
+    """
+    folder = folder or app.config["UPLOAD_FOLDER"]
+    tmp = os.path.join(folder, f".upload-{uuid.uuid4().hex}.part")
+    digest, size = hashlib.sha256(), 0
+    with open(tmp, "wb") as out:
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return tmp, digest.hexdigest(), size
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_blob(db, digest, size, ext):
+    """Take a reference on the content-addressed blob and return its filename.
+
+    Runs inside write(); once that commits, the caller moves the spooled
+    file into place with place_blob(). A failed transaction therefore
+    leaves no file behind. The committed reference keeps
+    sweep_released_blobs() away from the name, and identical content
+    collapses onto one file.
+    """
+    filename = f"{digest}.{ext}"
+    db.execute("""
+        INSERT INTO blobs (filename, sha256, size, refcount, created_at) VALUES (?,?,?,1,?)
+        ON CONFLICT(filename) DO UPDATE SET refcount=refcount+1, released_at=NULL
+    """, (filename, digest, size, datetime.utcnow().isoformat()))
+    return filename
+
+def place_blob(tmp_path, filename):
+    os.replace(tmp_path, os.path.join(app.config["UPLOAD_FOLDER"], filename))
+
+def safe_save_file(file, record):
+    """Store an uploaded file by content hash.
+
+    `record(db, filename)` runs in the same write transaction and saves
+    whatever references the file; its return value is passed through.
+    """
     ext = file.filename.rsplit(".", 1)[1].lower()
-    new_name = f"{uuid.uuid4().hex}.{ext}"
-    file.save(os.path.join(folder, new_name))
-    return new_name
+    tmp, digest, size = spool_upload(file.stream)
+    try:
+        result = write(lambda db: record(db, store_blob(db, digest, size, ext)))
+        place_blob(tmp, f"{digest}.{ext}")
+        return result
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def release_blob(db, filename):
+    """Drop one reference; files at zero are left for sweep_released_blobs()."""
+    db.execute("""
+        UPDATE blobs SET refcount=refcount-1,
+               released_at=CASE WHEN refcount<=1 THEN ? ELSE released_at END
+        WHERE filename=?
+    """, (datetime.utcnow().isoformat(), filename))
+
+def sweep_released_blobs(db, limit=500):
+    """Delete unreferenced upload files (and their derivatives) past the grace period.
+
+    Holds the write lock while unlinking, so a concurrent upload of the same
+    content either lands before (and revives the row) or after (and rewrites
+    the file). Run it through write(). Returns the number of files removed.
+    """
+    cutoff = (datetime.utcnow() - app.config["BLOB_RELEASE_GRACE"]).isoformat()
+    rows = db.execute("""
+        SELECT b.filename, m.variants FROM blobs b LEFT JOIN media m ON m.filename=b.filename
+        WHERE b.refcount<=0 AND b.released_at<? LIMIT ?
+    """, (cutoff, limit)).fetchall()
+    for filename, variants in rows:
+        for name in [filename, *media.derived_files(filename, variants)]:
+            try:
+                os.remove(os.path.join(app.config["UPLOAD_FOLDER"], name))
+            except FileNotFoundError:
+                pass
+        db.execute("DELETE FROM media WHERE filename=?", (filename,))
+        db.execute("DELETE FROM jobs WHERE filename=? AND status='queued'", (filename,))
+        db.execute("DELETE FROM blobs WHERE filename=?", (filename,))
+    return len(rows)
+
+def session_part_path(session_id):
+    return os.path.join(app.config["UPLOAD_SESSION_FOLDER"], f"{session_id}.part")
+
+try:
+    import fcntl
+except ImportError:  # Windows: chunk writes are then serialized only by the offset check
+    fcntl = None
+
+def lock_part_file(f):
+    """Take a non-blocking exclusive lock on an open partial upload, held until `f` is closed.
+
+    One chunk (or completion) per session at a time, across threads and
+    processes; returns False if another request holds it.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+def append_chunk(out, offset, stream, expected_sha=None, chunk_size=256 * 1024):
+    """Write `stream` into the open partial file at `offset`, hashing as it goes.
+
+    The file is truncated to `offset` first, so a retried chunk overwrites
+    whatever a dropped attempt left behind. On a checksum mismatch the
+    chunk is discarded again and None is returned; otherwise the number of
+    bytes written.
+    """
+    digest, written = hashlib.sha256(), 0
+    out.truncate(offset)
+    out.seek(offset)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        written += len(chunk)
+        if written > app.config["UPLOAD_CHUNK_MAX"]:
+            out.truncate(offset)
+            return None
+        digest.update(chunk)
+        out.write(chunk)
+    if expected_sha and digest.hexdigest() != expected_sha.lower():
+        out.truncate(offset)
+        return None
+    return written
+
+def purge_upload_sessions(db, limit=500):
+    """Forget upload sessions idle past UPLOAD_SESSION_TTL and delete their partial files."""
+    cutoff = (datetime.utcnow() - app.config["UPLOAD_SESSION_TTL"]).isoformat()
+    ids = [r[0] for r in db.execute("DELETE FROM upload_sessions WHERE id IN (SELECT id FROM upload_sessions WHERE updated_at<? LIMIT ?) RETURNING id", (cutoff, limit))]
+    for session_id in ids:
+        try:
+            os.remove(session_part_path(session_id))
+        except FileNotFoundError:
+            pass
+    return len(ids)
+
+@app.cli.command("purge-uploads")
+def purge_uploads_command():
+    """Delete abandoned chunked upload sessions."""
+    print(f"Purged {write(purge_upload_sessions)} upload session(s).")
+
+@app.cli.command("gc-blobs")
+def gc_blobs_command():
+    """Delete upload files whose last reference went away."""
+    print(f"Removed {write(sweep_released_blobs)} unreferenced file(s).")
 
 def validate_uploaded_file(file):
     if not file or file.filename == "":
@@ -157,6 +1253,8 @@ def login_required(f):
     @wraps(f)
     def wrapped(*args, **kwargs):
         if "user" not in session:
+            if request.path.startswith("/api/"):
+                return jsonify({"error": "Login required"}), 401
             return redirect(url_for("login"))
         return f(*args, **kwargs)
     return wrapped
@@ -165,12 +1263,738 @@ def user_exists(username):
     db = get_db()
     return bool(db.execute("SELECT 1 FROM users WHERE username=?", (username,)).fetchone())
 
+def encode_cursor(created_at, row_id):
+    """Opaque keyset cursor for a (created_at, id) position."""
+    return base64.urlsafe_b64encode(f"{created_at}|{row_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(); returns None for a missing or malformed cursor."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit("|", 1)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def comment_dict(c, viewer):
+    return {"id": c["id"], "username": c["username"], "text": c["text"], "own": c["username"] == viewer}
+
+def attach_latest_comments(db, posts, limit):
+    """Attach the newest `limit` comments (oldest first) to each post, in one query."""
+    by_id = {p["id"]: p for p in posts}
+    for p in posts:
+        p["comments"] = []
+        p["comments_cursor"] = None
+    if not by_id:
+        return posts
+    marks = ",".join("?" * len(by_id))
+    rows = db.execute(f"""
+        SELECT id, post_id, username, text, created_at FROM (
+            SELECT c.id, c.post_id, c.username, c.text, c.created_at,
+                   ROW_NUMBER() OVER (PARTITION BY c.post_id ORDER BY c.created_at DESC, c.id DESC) AS rn
+            FROM comments c WHERE c.post_id IN ({marks})
+        ) WHERE rn<=? ORDER BY post_id, created_at, id
+    """, (*by_id, limit)).fetchall()
+    for c in rows:
+        post = by_id[c["post_id"]]
+        if not post["comments"] and post["comment_count"] > limit:
+            post["comments_cursor"] = encode_cursor(c["created_at"], c["id"])
+        post["comments"].append(c)
+    return posts
+
+def fan_out_post(db, post_id, author, created_at):
+    """Copy a new post into its author's and followers' timelines (same transaction).
+
+    Authors with more than FANOUT_LIMIT followers are skipped; their posts
+    keep fanout=0 and are pulled in by feed_source() at read time.
+    """
+    db.execute("INSERT OR IGNORE INTO timeline (owner,created_at,post_id,author) VALUES (?,?,?,?)", (author, created_at, post_id, author))
+    followers = db.execute("SELECT followers_count FROM users WHERE username=?", (author,)).fetchone()
+    if followers and followers[0] > app.config["FANOUT_LIMIT"]:
+        return
+    db.execute("""
+        INSERT OR IGNORE INTO timeline (owner, created_at, post_id, author)
+        SELECT follower, ?, ?, ? FROM followers WHERE username=?
+    """, (created_at, post_id, author, author))
+    db.execute("UPDATE posts SET fanout=1 WHERE id=?", (post_id,))
+
+def backfill_timeline(db, owner, author):
+    """On follow: copy the author's recent posts into the new follower's timeline."""
+    db.execute("""
+        INSERT OR IGNORE INTO timeline (owner, created_at, post_id, author)
+        SELECT ?, created_at, id, username FROM posts
+        WHERE username=? AND type='post' ORDER BY created_at DESC LIMIT ?
+    """, (owner, author, app.config["TIMELINE_BACKFILL"]))
+
+def feed_source(db, viewer, after, limit):
+    """SQL + params selecting the next `limit` (id, created_at) feed entries for `viewer`.
+
+    Viewers who follow someone read their timeline rows (one range scan on
+    the primary key) merged with the not-fanned-out posts of accounts they
+    follow. Viewers who follow nobody get the global feed instead.
+    """
+    keyset, page = "", []
+    if after:
+        keyset, page = " AND ({t}<? OR ({t}=? AND {id}<?))", [after[0], after[0], after[1]]
+    following = db.execute("SELECT following_count FROM users WHERE username=?", (viewer,)).fetchone()
+    if not following or not following[0]:
+        return (f"SELECT id, created_at FROM posts WHERE type='post'{keyset.format(t='created_at', id='id')} ORDER BY created_at DESC, id DESC LIMIT ?",
+                [*page, limit])
+    return (f"""
+        SELECT * FROM (SELECT post_id AS id, created_at FROM timeline WHERE owner=?{keyset.format(t='created_at', id='post_id')}
+                       ORDER BY created_at DESC, post_id DESC LIMIT ?)
+        UNION
+        SELECT * FROM (SELECT p.id, p.created_at FROM followers f
+                       JOIN posts p INDEXED BY ix_posts_pull ON p.username=f.username AND p.type='post' AND p.fanout=0
+                       WHERE f.follower=?{keyset.format(t='p.created_at', id='p.id')}
+                       ORDER BY p.created_at DESC, p.id DESC LIMIT ?)
+    """, [viewer, *page, limit, viewer, *page, limit])
+
+def fetch_feed_page(db, viewer, cursor=None, limit=None):
+    """Return (posts, next_cursor) for one keyset page of the home feed, newest first."""
+    limit = limit or app.config["FEED_PAGE_SIZE"]
+    source, params = feed_source(db, viewer, decode_cursor(cursor), limit + 1)
+    rows = db.execute(f"""
+        SELECT p.*, u.profile_pic, {MEDIA_COLUMNS},
+               EXISTS(SELECT 1 FROM likes l WHERE l.post_id=p.id AND l.username=?) AS liked
+        FROM ({source}) s
+        JOIN posts p ON p.id=s.id
+        LEFT JOIN users u ON p.username=u.username
+        LEFT JOIN media m ON m.filename=p.filename
+        ORDER BY p.created_at DESC, p.id DESC
+        LIMIT ?
+    """, (viewer, *params, limit + 1)).fetchall()
+    posts = [dict(r) for r in rows[:limit]]
+    next_cursor = encode_cursor(posts[-1]["created_at"], posts[-1]["id"]) if len(rows) > limit else None
+    return posts, next_cursor
+
+def render_feed_posts(db, posts, viewer, first_page=False):
+    """Set post["html"] for each feed post, reusing cached fragments.
+
+    A fragment depends on the viewer and on the post:<id> version; the
+    counters and media state shown in it are part of the key as well.
+    Comments are only queried for the posts that missed the cache.
+    """
+    versions = cache_versions(f"post:{p['id']}" for p in posts)
+    keys = {p["id"]: versioned_key(
+        f"feed-post:{p['id']}:{viewer}:{p['liked']}:{p['like_count']}:{p['comment_count']}:{p['media_status']}:{first_page and i == 0}",
+        [f"post:{p['id']}"], versions) for i, p in enumerate(posts)}
+    hits = get_cache().get_many(keys.values())
+    misses = [p for p in posts if keys[p["id"]] not in hits]
+    attach_latest_comments(db, misses, app.config["FEED_COMMENTS_PER_POST"])
+    for i, p in enumerate(posts):
+        html = hits.get(keys[p["id"]])
+        if html is None:
+            html = render_template("_feed_post.html", post=p, user=viewer, eager=first_page and i == 0)
+            get_cache().set(keys[p["id"]], html)
+        p["html"] = Markup(html)
+    return posts
+
+def parse_id_list(raw, limit):
+    """Parse "1,2,3" into a de-duplicated list of at most `limit` ints."""
+    ids = []
+    for part in (raw or "").split(","):
+        if part.strip().isdigit() and int(part) not in ids:
+            ids.append(int(part))
+    return ids[:limit]
+
+def fts_query(text):
+    """Turn free text into an FTS5 MATCH expression (AND of quoted trigram terms).
+
+    Returns None when no term is long enough for the trigram index (< 3 chars).
+    """
+    terms = [t for t in text.split() if len(t) >= 3]
+    if not terms:
+        return None
+    return " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+def users_by_prefix(db, prefix, limit, offset=0):
+    """Usernames starting with `prefix`, ignoring case, most-followed first.
+
+    A range on ix_users_username_nocase rather than LIKE, so `_` and `%` in
+    the prefix are plain characters.
+    """
+    return db.execute("""
+        SELECT username, profile_pic FROM users
+        WHERE username>=? COLLATE NOCASE AND username<? COLLATE NOCASE
+        ORDER BY followers_count DESC, username LIMIT ? OFFSET ?
+    """, (prefix, prefix + "\U0010ffff", limit, offset)).fetchall()
+
+def search_users(db, query, limit, offset=0):
+    match = fts_query(query)
+    if match is None:
+        return users_by_prefix(db, query, limit, offset)  # too short for trigrams
+    return db.execute("""
+        SELECT u.username, u.profile_pic FROM users_fts
+        JOIN users u ON u.rowid=users_fts.rowid
+        WHERE users_fts MATCH ?
+        ORDER BY bm25(users_fts, 4.0, 1.0) - ? * (u.followers_count / (u.followers_count + 10.0))
+        LIMIT ? OFFSET ?
+    """, (match, app.config["SEARCH_POPULARITY_WEIGHT"], limit, offset)).fetchall()
+
+def search_posts(db, query, limit, offset=0):
+    match = fts_query(query)
+    if match is None:
+        return []
+    return db.execute(f"""
+        SELECT p.*, u.profile_pic, {MEDIA_COLUMNS} FROM posts_fts
+        JOIN posts p ON p.id=posts_fts.rowid
+        LEFT JOIN users u ON p.username=u.username
+        LEFT JOIN media m ON m.filename=p.filename
+        WHERE posts_fts MATCH ?
+        ORDER BY bm25(posts_fts, 2.0, 1.0)
+                 - ? / (1.0 + MAX(julianday('now') - julianday(p.created_at), 0))
+                 - ? * (p.like_count / (p.like_count + 10.0))
+        LIMIT ? OFFSET ?
+    """, (match, app.config["SEARCH_RECENCY_WEIGHT"], app.config["SEARCH_POPULARITY_WEIGHT"], limit, offset)).fetchall()
+
+# ==========================
+# Media Pipeline
+# ==========================
+_media_pool = None
+_media_pool_lock = threading.Lock()
+
+def media_pool():
+    """Shared worker pool for derivative generation, created on first use."""
+    global _media_pool
+    with _media_pool_lock:
+        if _media_pool is None:
+            _media_pool = ThreadPoolExecutor(app.config["MEDIA_WORKERS"], thread_name_prefix="media")
+        return _media_pool
+
+# Columns the templates need from `LEFT JOIN media m` to pick derivatives.
+MEDIA_COLUMNS = "m.width, m.height, m.variants, m.status AS media_status, m.poster, m.playback, m.duration"
+
+def register_media(db, filename):
+    """Record a freshly stored upload in the caller's transaction.
+
+    Returns the media kind that still needs processing ("image"/"video"), or
+    None. Videos also get a persistent job row for the video workers.
+    """
+    kind = "image" if media.is_image(filename) else "video" if media.is_video(filename) else None
+    if kind is None:
+        return None
+    now = datetime.utcnow().isoformat()
+    if not db.execute("INSERT OR IGNORE INTO media (filename,kind,status,created_at) VALUES (?,?,?,?)", (filename, kind, "pending", now)).rowcount:
+        return None
+    if kind == "video":
+        db.execute("INSERT INTO jobs (kind,filename,status,created_at,updated_at) VALUES ('video',?,'queued',?,?)", (filename, now, now))
+    return kind
+
+def process_image(filename):
+    """Worker task: build resized/WebP variants and record the image dimensions."""
+    try:
+        width, height, widths = media.make_image_variants(os.path.join(app.config["UPLOAD_FOLDER"], filename), app.config["UPLOAD_FOLDER"])
+        row = ("ready", width, height, ",".join(map(str, widths)))
+    except Exception:
+        app.logger.exception("Image processing failed for %s", filename)
+        row = ("failed", None, None, "")
+    def record(db):
+        db.execute("UPDATE media SET status=?, width=?, height=?, variants=? WHERE filename=?", (*row, filename))
+        bump_media(db, filename)
+    write(record)
+
+def bump_media(db, filename):
+    """Invalidate cached pages showing `filename` once its processing state changes."""
+    bump(db, "posts", *(name for (name,) in db.execute("""
+        SELECT 'post:' || id FROM posts WHERE filename=:f
+        UNION SELECT 'user:' || username FROM posts WHERE filename=:f
+        UNION SELECT 'user:' || username FROM users WHERE profile_pic=:f
+    """, {"f": filename})))
+
+def queue_media(filename, kind="image"):
+    """Kick off processing once the registering transaction has committed."""
+    if kind == "video":
+        wake_video_worker()
+    else:
+        media_pool().submit(process_image, filename)
+
+_video_wake = threading.Event()
+_video_thread = None
+_video_thread_lock = threading.Lock()
+
+def claim_video_job(db):
+    """Atomically move the oldest queued job to running; returns (id, filename) or None."""
+    stale = (datetime.utcnow() - app.config["VIDEO_JOB_STALE_AFTER"]).isoformat()
+    now = datetime.utcnow().isoformat()
+    db.execute("UPDATE jobs SET status='queued' WHERE status='running' AND updated_at<?", (stale,))
+    row = db.execute("""
+        UPDATE jobs SET status='running', attempts=attempts+1, updated_at=?
+        WHERE id=(SELECT id FROM jobs WHERE status='queued' ORDER BY id LIMIT 1)
+        RETURNING id, filename
+    """, (now,)).fetchone()
+    return tuple(row) if row else None
+
+def finish_video_job(db, job_id, filename, result=None, error=None):
+    now = datetime.utcnow().isoformat()
+    if result:
+        db.execute("UPDATE jobs SET status='done', error=NULL, updated_at=? WHERE id=?", (now, job_id))
+        db.execute("UPDATE media SET status='ready', width=?, height=?, duration=?, poster=?, playback=? WHERE filename=?",
+                   (result["width"], result["height"], result["duration"], result["poster"], result["playback"], filename))
+    else:
+        attempts = db.execute("SELECT attempts FROM jobs WHERE id=?", (job_id,)).fetchone()[0]
+        status = "failed" if attempts >= app.config["VIDEO_JOB_MAX_ATTEMPTS"] else "queued"
+        db.execute("UPDATE jobs SET status=?, error=?, updated_at=? WHERE id=?", (status, error, now, job_id))
+        if status == "failed":
+            db.execute("UPDATE media SET status='failed' WHERE filename=?", (filename,))
+    bump_media(db, filename)
+
+def run_video_jobs(stop_when_idle=False):
+    """Dispatcher loop: feed queued jobs from the DB into a process pool."""
+    folder = app.config["UPLOAD_FOLDER"]
+    inflight = {}
+    # Spawned, not forked: this process already runs the DB writer and thread
+    # pools, and a forked child can inherit one of their locks mid-acquire.
+    with ProcessPoolExecutor(app.config["VIDEO_WORKERS"], mp_context=multiprocessing.get_context("spawn")) as pool:
+        while True:
+            while len(inflight) < app.config["VIDEO_WORKERS"]:
+                job = write(claim_video_job)
+                if not job:
+                    break
+                inflight[pool.submit(media.process_video, os.path.join(folder, job[1]), folder)] = job
+            if not inflight:
+                if stop_when_idle:
+                    break
+                _video_wake.wait(timeout=60)
+                _video_wake.clear()
+                continue
+            done, _ = wait(inflight, timeout=5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                job_id, filename = inflight.pop(fut)
+                try:
+                    result, error = fut.result(), None
+                except Exception as e:
+                    app.logger.exception("Video job %s failed for %s", job_id, filename)
+                    result, error = None, str(e)[:500]
+                write(lambda db: finish_video_job(db, job_id, filename, result=result, error=error))
+
+def wake_video_worker():
+    """Start the in-process dispatcher if needed and tell it there is work."""
+    global _video_thread
+    if app.config["VIDEO_WORKER_MODE"] != "inline":
+        return
+    with _video_thread_lock:
+        if _video_thread is None or not _video_thread.is_alive():
+            _video_thread = threading.Thread(target=run_video_jobs, name="video-dispatcher", daemon=True)
+            _video_thread.start()
+    _video_wake.set()
+
+@app.before_request
+def resume_video_jobs():
+    # Pick up jobs left queued by a previous run as soon as this process serves traffic.
+    if _video_thread is None:
+        wake_video_worker()
+
+@app.cli.command("video-worker")
+def video_worker_command():
+    """Process queued video jobs in the foreground (for VIDEO_WORKER_MODE=external)."""
+    run_video_jobs()
+
+def media_url(filename, variants, want=None):
+    """URL of the smallest derivative at least `want` px wide (largest if none), else the original."""
+    widths = [int(w) for w in (variants or "").split(",") if w]
+    if not widths:
+        return url_for("uploaded_file", filename=filename)
+    pick = next((w for w in widths if want and w >= want), widths[-1])
+    return url_for("uploaded_file", filename=media.variant_name(filename, pick))
+
+def share_url(filename, variants):
+    """Public link for the share button. Images link their largest derivative,
+    which is EXIF-free, and have no link until the workers have made it."""
+    if not media.is_image(filename):
+        return url_for("uploaded_file", filename=filename)
+    return media_url(filename, variants) if variants else None
+
+app.jinja_env.globals.update(variant_name=media.variant_name, media_url=media_url, share_url=share_url)
+
+@app.cli.command("media-backfill")
+def media_backfill_command():
+    """Generate derivatives for every image upload that does not have them yet."""
+    def register_all(db):
+        for (name,) in db.execute("SELECT filename FROM posts UNION SELECT profile_pic FROM users").fetchall():
+            if name and os.path.exists(os.path.join(app.config["UPLOAD_FOLDER"], name)):
+                register_media(db, name)
+        return [r[0] for r in db.execute("SELECT filename FROM media WHERE kind='image' AND status!='ready'")]
+    todo = write(register_all)
+    for name in todo:
+        process_image(name)
+    print(f"Processed {len(todo)} image(s); videos are queued for the video workers.")
+
+# ==========================
+# Notifications
+# ==========================
+def notify(db, recipient, actor, kind, post_id=0, preview=None):
+    """Record `actor` doing `kind` to `recipient`; call inside write().
+
+    While the recipient has an unread notification for the same kind and
+    post, the action is folded into it instead of adding a row. Returns
+    the recipient's unread count for publish_unread(), or None for
+    actions on one's own posts.
+    """
+    if recipient == actor:
+        return None
+    now = datetime.utcnow().isoformat()
+    preview = preview and preview[:120]
+    row = db.execute("SELECT id FROM notifications WHERE recipient=? AND kind=? AND post_id=? AND read=0", (recipient, kind, post_id)).fetchone()
+    if row is None:
+        nid = db.execute("""INSERT INTO notifications (recipient, kind, post_id, actor, preview, created_at, updated_at)
+                            VALUES (?,?,?,?,?,?,?)""", (recipient, kind, post_id, actor, preview, now, now)).lastrowid
+        db.execute("INSERT INTO notification_actors (notification_id, actor) VALUES (?,?)", (nid, actor))
+        return db.execute("UPDATE users SET unread_notifications=unread_notifications+1 WHERE username=? RETURNING unread_notifications", (recipient,)).fetchone()[0]
+    added = db.execute("INSERT OR IGNORE INTO notification_actors (notification_id, actor) VALUES (?,?)", (row["id"], actor)).rowcount
+    db.execute("UPDATE notifications SET actor=?, actor_count=actor_count+?, preview=COALESCE(?, preview), updated_at=? WHERE id=?",
+               (actor, added, preview, now, row["id"]))
+    return db.execute("SELECT unread_notifications FROM users WHERE username=?", (recipient,)).fetchone()[0]
+
+def delete_notifications(db, where, params):
+    """Delete notifications matching `where`, keeping unread counters right; returns the count."""
+    rows = db.execute(f"DELETE FROM notifications WHERE {where} RETURNING id, recipient, read", params).fetchall()
+    unread = Counter(r["recipient"] for r in rows if not r["read"])
+    db.executemany("UPDATE users SET unread_notifications=MAX(unread_notifications-?, 0) WHERE username=?", [(n, u) for u, n in unread.items()])
+    db.executemany("DELETE FROM notification_actors WHERE notification_id=?", [(r["id"],) for r in rows])
+    return len(rows)
+
+def notification_dict(n):
+    others = n["actor_count"] - 1
+    verb = {"like": "liked your post", "comment": "commented on your post", "follow": "started following you"}[n["kind"]]
+    who = n["actor"] + (f" and {others} other{'s' if others > 1 else ''}" if others else "")
+    return {"id": n["id"], "kind": n["kind"], "post_id": n["post_id"] or None, "actor": n["actor"], "actor_count": n["actor_count"],
+            "text": f"{who} {verb}", "preview": n["preview"], "read": bool(n["read"]), "updated_at": n["updated_at"]}
+
+def fetch_notifications(db, username, cursor=None, limit=None):
+    """(notifications, next_cursor): newest activity first, keyset-paged on (updated_at, id)."""
+    limit = limit or app.config["NOTIFICATIONS_PAGE_SIZE"]
+    after, keyset, page = decode_cursor(cursor), "", []
+    if after:
+        keyset, page = " AND (updated_at<? OR (updated_at=? AND id<?))", [after[0], after[0], after[1]]
+    rows = db.execute(f"SELECT * FROM notifications WHERE recipient=?{keyset} ORDER BY updated_at DESC, id DESC LIMIT ?",
+                      (username, *page, limit + 1)).fetchall()
+    items = [notification_dict(n) for n in rows[:limit]]
+    next_cursor = encode_cursor(items[-1]["updated_at"], items[-1]["id"]) if len(rows) > limit else None
+    return items, next_cursor
+
+def mark_notifications_read(username):
+    def apply(db):
+        db.execute("UPDATE notifications SET read=1 WHERE recipient=? AND read=0", (username,))
+        db.execute("UPDATE users SET unread_notifications=0 WHERE username=?", (username,))
+    write(apply)
+    publish_unread(username, 0)
+
+# ==========================
+# Maintenance
+# ==========================
+# Periodic clean-up jobs. Each job takes (db, limit), does at most `limit`
+# units of work inside one write() transaction and returns how many it did;
+# run_maintenance_job() repeats it in paced batches until it comes up short.
+def delete_posts(db, where, params):
+    """Delete posts matching `where` with everything hanging off them; returns the count."""
+    rows = db.execute(f"SELECT id, filename, username FROM posts WHERE {where}", params).fetchall()
+    if not rows:
+        return 0
+    for r in rows:
+        release_blob(db, r["filename"])
+    bump(db, "posts", *(f"post:{r['id']}" for r in rows), *(f"user:{r['username']}" for r in rows))
+    ids = [r["id"] for r in rows]
+    marks = ",".join("?" * len(ids))
+    db.execute(f"""UPDATE users SET post_count=post_count-(SELECT COUNT(*) FROM posts p WHERE p.id IN ({marks}) AND p.type='post' AND p.username=users.username)
+                   WHERE username IN (SELECT username FROM posts WHERE id IN ({marks}) AND type='post')""", ids * 2)
+    for table, column in (("likes", "post_id"), ("comments", "post_id"), ("timeline", "post_id"), ("posts", "id")):
+        db.execute(f"DELETE FROM {table} WHERE {column} IN ({marks})", ids)
+    delete_notifications(db, f"post_id IN ({marks})", ids)
+    return len(ids)
+
+def expire_stories(db, limit):
+    cutoff = (datetime.utcnow() - app.config["STORY_TTL"]).isoformat()
+    return delete_posts(db, "id IN (SELECT id FROM posts WHERE type='story' AND created_at<? ORDER BY created_at LIMIT ?)", (cutoff, limit))
+
+def purge_user(db, username, guest_only=False):
+    """Remove a user and everything they left behind, keeping other users' counters right."""
+    if not db.execute("SELECT 1 FROM users WHERE username=?" + (" AND guest=1" if guest_only else ""), (username,)).fetchone():
+        return 0
+    delete_posts(db, "username=?", (username,))
+    db.execute("UPDATE posts SET like_count=like_count-1 WHERE id IN (SELECT post_id FROM likes WHERE username=?)", (username,))
+    db.execute("DELETE FROM likes WHERE username=?", (username,))
+    db.execute("""UPDATE posts SET comment_count=comment_count-(SELECT COUNT(*) FROM comments c WHERE c.post_id=posts.id AND c.username=?)
+                  WHERE id IN (SELECT post_id FROM comments WHERE username=?)""", (username, username))
+    db.execute("DELETE FROM comments WHERE username=?", (username,))
+    bump(db, "users", f"user:{username}", *(f"user:{r[0]}" for r in db.execute(
+        "SELECT username FROM followers WHERE follower=? UNION SELECT follower FROM followers WHERE username=?", (username, username))))
+    db.execute("UPDATE users SET followers_count=followers_count-1 WHERE username IN (SELECT username FROM followers WHERE follower=?)", (username,))
+    db.execute("UPDATE users SET following_count=following_count-1 WHERE username IN (SELECT follower FROM followers WHERE username=?)", (username,))
+    db.execute("DELETE FROM followers WHERE follower=?", (username,))
+    db.execute("DELETE FROM followers WHERE username=?", (username,))
+    db.execute("DELETE FROM timeline WHERE owner=?", (username,))
+    delete_notifications(db, "recipient=?", (username,))
+    # Notifications they caused for others lose them as an actor (and go away if they were the only one).
+    # Each step is keyed by notification_actors(actor), so none of them scans notifications.
+    theirs = "id IN (SELECT notification_id FROM notification_actors WHERE actor=?)"
+    db.execute(f"UPDATE notifications SET actor_count=actor_count-1 WHERE {theirs}", (username,))
+    delete_notifications(db, f"actor_count<=0 AND {theirs}", (username,))
+    db.execute(f"""UPDATE notifications SET actor=(SELECT MIN(a.actor) FROM notification_actors a WHERE a.notification_id=notifications.id AND a.actor!=?)
+                   WHERE actor=? AND {theirs}""", (username, username, username))
+    db.execute("DELETE FROM notification_actors WHERE actor=?", (username,))
+    for (session_id,) in db.execute("DELETE FROM upload_sessions WHERE username=? RETURNING id", (username,)).fetchall():
+        try:
+            os.remove(session_part_path(session_id))
+        except FileNotFoundError:
+            pass
+    pic = db.execute("DELETE FROM users WHERE username=? RETURNING profile_pic", (username,)).fetchone()
+    release_blob(db, pic["profile_pic"])
+    return 1
+
+def purge_guests(db, limit):
+    cutoff = (datetime.utcnow() - app.config["GUEST_TTL"]).isoformat()
+    guests = db.execute("SELECT username FROM users WHERE guest=1 AND created_at<? LIMIT ?", (cutoff, limit)).fetchall()
+    return sum(purge_user(db, g["username"]) for g in guests)
+
+def is_temp_upload(name):
+    return name.startswith(".upload-") or ".tmp" in name  # left by an interrupted upload or media worker
+
+def sweep_orphan_files(db, limit):
+    """Delete stale temp files and abandoned partial uploads.
+
+    Several databases (seed, bench, imports) can share one upload folder, so
+    finished uploads are never deleted for merely being unknown to this DB:
+    only blobs it tracked and released go, via sweep_released_blobs(). Temp
+    files are left for BLOB_RELEASE_GRACE and partial uploads for
+    UPLOAD_SESSION_TTL, past which no live upload still writes to them.
+    """
+    now = time.time()
+    sessions = {r[0] for r in db.execute("SELECT id FROM upload_sessions")}
+    removed = 0
+    for folder, max_age, orphaned in (
+        (app.config["UPLOAD_FOLDER"], app.config["BLOB_RELEASE_GRACE"], is_temp_upload),
+        (app.config["UPLOAD_SESSION_FOLDER"], app.config["UPLOAD_SESSION_TTL"], lambda name: name.split(".")[0] not in sessions),
+    ):
+        cutoff = now - max_age.total_seconds()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if removed >= limit:
+                    return removed
+                if entry.is_file() and entry.stat().st_mtime < cutoff and orphaned(entry.name):
+                    try:
+                        os.remove(entry.path)
+                        removed += 1
+                    except FileNotFoundError:
+                        pass
+    return removed
+
+def prune_notifications(db, limit):
+    cutoff = (datetime.utcnow() - app.config["NOTIFICATION_TTL"]).isoformat()
+    return delete_notifications(db, "id IN (SELECT id FROM notifications WHERE read=1 AND updated_at<? LIMIT ?)", (cutoff, limit))
+
+def prune_maintenance_runs(db, limit):
+    cutoff = (datetime.utcnow() - app.config["MAINTENANCE_HISTORY"]).isoformat()
+    return db.execute("DELETE FROM maintenance_runs WHERE id IN (SELECT id FROM maintenance_runs WHERE started_at<? LIMIT ?)", (cutoff, limit)).rowcount
+
+MAINTENANCE_JOBS = [
+    ("expire_stories", expire_stories),
+    ("purge_guests", purge_guests),
+    ("purge_upload_sessions", purge_upload_sessions),
+    ("sweep_released_blobs", sweep_released_blobs),  # after the purges, which release blobs
+    ("sweep_orphan_files", sweep_orphan_files),
+    ("prune_notifications", prune_notifications),
+    ("prune_maintenance_runs", prune_maintenance_runs),
+]
+
+def run_maintenance_job(name, job):
+    """Run one job in paced batches and record the run in maintenance_runs."""
+    started, t0 = datetime.utcnow().isoformat(), time.monotonic()
+    run_id = write(lambda db: db.execute("INSERT INTO maintenance_runs (job, started_at) VALUES (?,?)", (name, started)).lastrowid)
+    processed = batches = 0
+    status, error = "ok", None
+    try:
+        while batches < app.config["MAINTENANCE_MAX_BATCHES"]:
+            done = write(lambda db: job(db, app.config["MAINTENANCE_BATCH"]))
+            processed += done; batches += 1
+            if done < app.config["MAINTENANCE_BATCH"]:
+                break
+            time.sleep(app.config["MAINTENANCE_PAUSE"])
+    except Exception as e:
+        app.logger.exception("Maintenance job %s failed", name)
+        status, error = "failed", str(e)[:500]
+    write(lambda db: db.execute("UPDATE maintenance_runs SET duration_ms=?, processed=?, batches=?, status=?, error=? WHERE id=?",
+                                ((time.monotonic() - t0) * 1000, processed, batches, status, error, run_id)))
+    return {"job": name, "processed": processed, "batches": batches, "status": status}
+
+def claim_maintenance_slot(db):
+    """True if no process has started a maintenance run within the interval."""
+    since = (datetime.utcnow() - app.config["MAINTENANCE_INTERVAL"]).isoformat()
+    if db.execute("SELECT 1 FROM maintenance_runs WHERE job='cycle' AND started_at>?", (since,)).fetchone():
+        return False
+    db.execute("INSERT INTO maintenance_runs (job, started_at, status) VALUES ('cycle', ?, 'ok')", (datetime.utcnow().isoformat(),))
+    return True
+
+def run_maintenance(force=False):
+    """Run every job once, unless another process already did within MAINTENANCE_INTERVAL."""
+    if not force and not write(claim_maintenance_slot):
+        return []
+    return [run_maintenance_job(name, job) for name, job in MAINTENANCE_JOBS]
+
+_maintenance_thread = None
+_maintenance_lock = threading.Lock()
+
+def maintenance_loop():
+    interval = app.config["MAINTENANCE_INTERVAL"].total_seconds()
+    time.sleep(random.uniform(0, min(interval, 60)))  # spread out processes started together
+    while True:
+        try:
+            run_maintenance()
+        except Exception:
+            app.logger.exception("Maintenance cycle failed")
+        time.sleep(interval)
+
+@app.before_request
+def start_maintenance():
+    global _maintenance_thread
+    if _maintenance_thread is not None or app.config["MAINTENANCE_MODE"] != "inline":
+        return
+    with _maintenance_lock:
+        if _maintenance_thread is None:
+            _maintenance_thread = threading.Thread(target=maintenance_loop, name="maintenance", daemon=True)
+            _maintenance_thread.start()
+
+@app.cli.command("maintenance")
+@click.option("--once", is_flag=True, help="Run every job once and exit.")
+def maintenance_command(once):
+    """Run the maintenance jobs (for MAINTENANCE_MODE=external, e.g. from cron)."""
+    if not once:
+        maintenance_loop()
+    for r in run_maintenance(force=True):
+        print(f"{r['job']}: {r['processed']} in {r['batches']} batch(es) [{r['status']}]")
+
+# ==========================
+# Live Updates (in-process pub/sub)
+# ==========================
+class EventBroker:
+    """Fan events out to subscriber queues by topic (e.g. "post:12").
+
+    Lives in this process only: with several app processes each one only
+    sees the writes it served, so clients should also resync on reconnect.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = {}
+
+    def subscribe(self, topics, maxsize=256):
+        q = queue.Queue(maxsize)
+        with self._lock:
+            for t in topics:
+                self._topics.setdefault(t, set()).add(q)
+        q.topics = tuple(topics)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            for t in q.topics:
+                subs = self._topics.get(t)
+                if subs:
+                    subs.discard(q)
+                    if not subs:
+                        del self._topics[t]
+
+    def publish(self, topic, data):
+        with self._lock:
+            subs = list(self._topics.get(topic, ()))
+        for q in subs:
+            try:
+                q.put_nowait((topic, data))
+            except queue.Full:
+                pass  # slow consumer; it resyncs on reconnect
+
+broker = EventBroker()
+
+def publish_counts(post_id, **counts):
+    broker.publish(f"post:{post_id}", {"id": post_id, **counts})
+
+def publish_unread(username, unread):
+    """Wake only `username`'s live-counts streams, as a "notifications" event."""
+    if unread is not None:
+        broker.publish(f"user:{username}", {"unread": unread})
+
+def sse_stream(q, events):
+    """Yield server-sent events from a broker queue until the client goes away.
+
+    `events` maps a topic prefix ("post") to the SSE event name ("counts").
+    """
+    heartbeat = app.config["LIVE_COUNTS_HEARTBEAT"]
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                topic, data = q.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {events[topic.split(':', 1)[0]]}\ndata: {json.dumps(data)}\n\n"
+    finally:
+        broker.unsubscribe(q)
+
+# <sha256>.<ext> or a derivative like <sha256>_w320.webp
+CONTENT_NAME = re.compile(r"^[0-9a-f]{64}(?:_[a-z0-9]+)?\.[a-z0-9]+$")
+
+# ==========================
+# Static Assets / Service Worker
+# ==========================
+# ASSET_VERSION is a hash of static/ (minus uploads) and templates/. It is
+# appended to every url_for('static') URL and baked into the service worker,
+# so a deploy changes both the asset URLs and the worker's cache names.
+_asset_version = None
+
+def asset_version():
+    global _asset_version
+    if _asset_version is None:
+        h = hashlib.sha256()
+        uploads = os.path.abspath(app.config["UPLOAD_FOLDER"])
+        for root in (app.static_folder, os.path.join(app.root_path, app.template_folder)):
+            for folder, dirs, files in os.walk(root):
+                dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(folder, d)) != uploads)
+                for name in sorted(files):
+                    h.update(name.encode())
+                    with open(os.path.join(folder, name), "rb") as f:
+                        h.update(f.read())
+        _asset_version = h.hexdigest()[:12]
+    return _asset_version
+
+@app.url_defaults
+def version_static_urls(endpoint, values):
+    if endpoint == "static" and "v" not in values:
+        values["v"] = asset_version()
+
+def static_max_age(filename):
+    # Versioned URLs change on every deploy, so they can be cached for good.
+    return 365 * 24 * 3600 if request.args.get("v") == asset_version() else None
+
+app.get_send_file_max_age = static_max_age
+
 # ==========================
 # Routes
 # ==========================
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
+    # Content-addressed names (and their derivatives) never change meaning, so
+    # they get a strong ETag from the name and a one-year immutable lifetime.
+    # Range / If-Range requests are answered by send_file's conditional mode.
+    if not CONTENT_NAME.match(filename):
+        return send_from_directory(app.config["UPLOAD_FOLDER"], filename, conditional=True)
+    resp = send_from_directory(app.config["UPLOAD_FOLDER"], filename, conditional=True,
+                               etag=filename.rsplit(".", 1)[0], max_age=365 * 24 * 3600)
+    resp.cache_control.public = True
+    resp.cache_control.immutable = True
+    return resp
+
+@app.route("/service-worker.js")
+def service_worker():
+    # Served from the root (not /static/) so the worker's scope covers the whole app.
+    with open(os.path.join(app.static_folder, "service-worker.js"), encoding="utf-8") as f:
+        script = f.read().replace("__ASSET_VERSION__", asset_version())
+    resp = Response(script, mimetype="application/javascript")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Service-Worker-Allowed"] = "/"
+    return resp
 
 @app.route("/")
 def splash():
@@ -192,12 +2016,16 @@ def signup():
             return render_template("signup.html", error="Username already exists")
 
         pw_hash = generate_password_hash(p)
-        db = get_db()
-        db.execute(
-            "INSERT INTO users (username, password_hash, email, guest, created_at) VALUES (?, ?, ?, ?, ?)",
-            (u, pw_hash, e, 0, datetime.utcnow().isoformat())
-        )
-        db.commit()
+        def create(db):
+            if not db.execute(
+                "INSERT OR IGNORE INTO users (username, password_hash, email, guest, created_at) VALUES (?, ?, ?, ?, ?)",
+                (u, pw_hash, e, 0, datetime.utcnow().isoformat())
+            ).rowcount: return False
+            bump(db, "users", f"user:{u}")
+            return True
+        created = write(create)
+        if not created:
+            return render_template("signup.html", error="Username already exists")
         session["user"] = u
         flash("Account created and logged in.")
         return redirect(url_for("index"))
@@ -220,16 +2048,17 @@ def login():
 
 @app.route("/guest")
 def guest_login():
-    db = get_db()
-    while True:
-        guest_name = f"Guest_{random.randint(1000,9999)}"
-        if not user_exists(guest_name): break
-
-    db.execute(
-        "INSERT INTO users (username, password_hash, bio, profile_pic, email, guest, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (guest_name, None, "I am a guest user.", "user.png", None, 1, datetime.utcnow().isoformat())
-    )
-    db.commit()
+    def create_guest(db):
+        while True:
+            guest_name = f"Guest_{random.randint(1000,9999)}"
+            if db.execute(
+                "INSERT OR IGNORE INTO users (username, password_hash, bio, profile_pic, email, guest, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (guest_name, None, "I am a guest user.", "user.png", None, 1, datetime.utcnow().isoformat())
+            ).rowcount:
+                bump(db, "users", f"user:{guest_name}")
+                return guest_name
+
+    guest_name = write(create_guest)
     session["user"] = guest_name
     flash(f"Logged in as guest: {guest_name}")
     return redirect(url_for("index"))
@@ -238,9 +2067,7 @@ def guest_login():
 def logout():
     u = session.pop("user", None)
     if u and u.startswith("Guest_"):
-        db = get_db()
-        db.execute("DELETE FROM users WHERE username=? AND guest=1", (u,))
-        db.commit()
+        write(lambda db: purge_user(db, u, guest_only=True))
     flash("Logged out.")
     return redirect(url_for("login"))
 
@@ -252,26 +2079,63 @@ def logout():
 def index():
     db = get_db()
     u = session["user"]
-    posts = db.execute("""
-        SELECT p.*, u.profile_pic,
-               (SELECT COUNT(*) FROM likes l WHERE l.post_id=p.id) AS like_count,
+    posts, next_cursor = fetch_feed_page(db, u, request.args.get("cursor"))
+    render_feed_posts(db, posts, u, first_page=not request.args.get("cursor"))
+    if request.args.get("partial"):
+        # Infinite scroll asks for just the next page of posts.
+        return render_template("feed_posts.html", user=u, posts=posts, next_cursor=next_cursor)
+
+    cutoff = datetime.utcnow() - app.config["STORY_TTL"]
+    stories = cached("stories", ["posts"], lambda: [dict(r) for r in db.execute(
+        f"SELECT p.*, {MEDIA_COLUMNS} FROM posts p LEFT JOIN media m ON m.filename=p.filename WHERE p.type='story' AND p.created_at>=? ORDER BY p.created_at DESC",
+        (cutoff.isoformat(),))], ttl=60)
+    return render_template("index.html", user=u, posts=posts, next_cursor=next_cursor, stories=stories)
+
+@app.route("/comments/<int:post_id>")
+@login_required
+def load_comments(post_id):
+    """Older comments for a post, paged backwards from the `before` cursor ("load more")."""
+    db = get_db(); u = session["user"]
+    limit = min(request.args.get("limit", app.config["COMMENTS_PAGE_SIZE"], type=int), 100)
+    before = decode_cursor(request.args.get("before"))
+    where, params = "post_id=?", [post_id]
+    if before:
+        where += " AND (created_at<? OR (created_at=? AND id<?))"
+        params += [before[0], before[0], before[1]]
+    rows = db.execute(f"SELECT id, username, text, created_at FROM comments WHERE {where} ORDER BY created_at DESC, id DESC LIMIT ?", (*params, limit + 1)).fetchall()
+    page = rows[:limit]
+    next_cursor = encode_cursor(page[-1]["created_at"], page[-1]["id"]) if len(rows) > limit else None
+    return jsonify({"comments": [comment_dict(c, u) for c in reversed(page)], "next_cursor": next_cursor})
+
+@app.route("/like-counts")
+@login_required
+def like_counts():
+    """Like counts and the viewer's liked state for ?ids=1,2,3 in a single query."""
+    ids = parse_id_list(request.args.get("ids"), app.config["COUNTS_BATCH_LIMIT"])
+    if not ids:
+        return jsonify({})
+    marks = ",".join("?" * len(ids))
+    rows = get_db().execute(f"""
+        SELECT p.id, p.like_count,
                EXISTS(SELECT 1 FROM likes l WHERE l.post_id=p.id AND l.username=?) AS liked
-        FROM posts p
-        LEFT JOIN users u ON p.username=u.username
-        WHERE p.type='post'
-        ORDER BY p.created_at DESC
-    """, (u,)).fetchall()
+        FROM posts p WHERE p.id IN ({marks})
+    """, (session["user"], *ids)).fetchall()
+    return jsonify({str(r["id"]): {"like_count": r["like_count"], "liked": bool(r["liked"])} for r in rows})
 
-    posts_with_comments = []
-    for post in posts:
-        comments = db.execute("SELECT id, username, text FROM comments WHERE post_id=? ORDER BY created_at ASC", (post["id"],)).fetchall()
-        post = dict(post)
-        post["comments"] = comments
-        posts_with_comments.append(post)
+@app.route("/stream/counts")
+@login_required
+def stream_counts():
+    """SSE stream of like/comment count changes for ?ids=1,2,3, plus the viewer's unread count.
 
-    cutoff = datetime.utcnow() - timedelta(hours=24)
-    stories = db.execute("SELECT * FROM posts WHERE type='story' AND created_at>=? ORDER BY created_at DESC", (cutoff.isoformat(),)).fetchall()
-    return render_template("index.html", user=u, posts=posts_with_comments, stories=stories)
+    One stream per page: a second EventSource would hold another of the
+    browser's six HTTP/1.1 connections per origin in every open tab.
+    """
+    if not app.config["LIVE_COUNTS_ENABLED"]:
+        return jsonify({"error": "Live counts disabled"}), 404
+    ids = parse_id_list(request.args.get("ids"), app.config["COUNTS_BATCH_LIMIT"])
+    q = broker.subscribe([f"post:{i}" for i in ids] + [f"user:{session['user']}"])
+    return Response(sse_stream(q, {"post": "counts", "user": "notifications"}), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ==========================
 # Modernized Explore
@@ -281,16 +2145,35 @@ def index():
 def explore():
     db = get_db()
     query = request.args.get("query","").strip()
-    results=[]
+    page = max(request.args.get("page", 1, type=int), 1)
+    size = app.config["SEARCH_PAGE_SIZE"]; offset = (page-1)*size
+    def search():
+        users = search_users(db, query, size+1, offset)
+        posts = search_posts(db, query, size+1, offset)
+        return [{"type":"user","username":u["username"]} for u in users[:size]] + [post_result(p) for p in posts[:size]], len(users) > size or len(posts) > size
+    def latest():
+        posts = db.execute(f"SELECT p.*, u.profile_pic, {MEDIA_COLUMNS} FROM posts p LEFT JOIN users u ON p.username=u.username LEFT JOIN media m ON m.filename=p.filename ORDER BY p.created_at DESC LIMIT ? OFFSET ?", (size+1, offset)).fetchall()
+        return [post_result(p) for p in posts[:size]], len(posts) > size
     if query:
-        users = db.execute("SELECT username FROM users WHERE username LIKE ? LIMIT 20", (f"%{query}%",)).fetchall()
-        results += [{"type":"user","username":u["username"]} for u in users]
-        posts = db.execute("SELECT p.*, u.profile_pic FROM posts p LEFT JOIN users u ON p.username=u.username WHERE p.caption LIKE ? ORDER BY p.created_at DESC LIMIT 20", (f"%{query}%",)).fetchall()
-        results += [{"type":"post","user":p["username"],"filename":p["filename"],"caption":p["caption"]} for p in posts]
+        # Keyed on the query as typed: the key must never merge queries that can return different rows.
+        results, has_more = cached(f"search:{page}:{query}", ["posts", "users"], search, ttl=app.config["SEARCH_CACHE_TTL"])
     else:
-        posts = db.execute("SELECT p.*, u.profile_pic FROM posts p LEFT JOIN users u ON p.username=u.username ORDER BY p.created_at DESC LIMIT 20").fetchall()
-        results += [{"type":"post","user":p["username"],"filename":p["filename"],"caption":p["caption"]} for p in posts]
-    return render_template("explore.html", results=results, query=query, user=session.get("user"))
+        results, has_more = cached(f"explore:{page}", ["posts"], latest)
+    return render_template("explore.html", results=results, query=query, page=page, has_more=has_more, user=session.get("user"))
+
+def post_result(p):
+    return {"type":"post","id":p["id"],"user":p["username"],"filename":p["filename"],"caption":p["caption"],
+            "width":p["width"],"height":p["height"],"variants":p["variants"],
+            "media_status":p["media_status"],"poster":p["poster"],"playback":p["playback"]}
+
+@app.route("/search/suggest")
+@login_required
+def search_suggest():
+    """Username autocomplete for the explore search box."""
+    q = request.args.get("q","").strip()
+    if not q: return jsonify([])
+    rows = users_by_prefix(get_db(), q, 8)
+    return jsonify([{"username": r["username"], "profile_pic": r["profile_pic"]} for r in rows])
 
 # ==========================
 # Upload / Stories
@@ -304,40 +2187,171 @@ def upload():
         type_post = request.form.get("type","post")
         valid,msg=validate_uploaded_file(f)
         if not valid: flash(msg); return redirect(request.referrer or url_for("index"))
-        filename = safe_save_file(f)
-        db = get_db()
-        db.execute("INSERT INTO posts (username,filename,caption,type,created_at) VALUES (?,?,?,?,?)", (session["user"], filename, caption, type_post, datetime.utcnow().isoformat()))
-        db.commit()
+        u = session["user"]
+        filename, kind = safe_save_file(f, lambda db, filename: create_post(db, u, filename, caption, type_post))
+        if kind: queue_media(filename, kind)
         flash(f"{type_post.capitalize()} uploaded successfully!")
         return redirect(url_for("index"))
     return render_template("upload.html", user=session.get("user"))
 
+def create_post(db, username, filename, caption, type_post):
+    """Insert a post/story for a stored file; returns (filename, media kind to queue)."""
+    now = datetime.utcnow().isoformat()
+    post_id = db.execute("INSERT INTO posts (username,filename,caption,type,created_at) VALUES (?,?,?,?,?)", (username, filename, caption, type_post, now)).lastrowid
+    if type_post=="post":
+        db.execute("UPDATE users SET post_count=post_count+1 WHERE username=?",(username,))
+        fan_out_post(db, post_id, username, now)
+    bump(db, "posts", f"user:{username}")
+    return filename, register_media(db, filename)
+
+def get_upload_session(session_id):
+    return get_db().execute("SELECT * FROM upload_sessions WHERE id=? AND username=?", (session_id, session["user"])).fetchone()
+
+@app.route("/upload/session", methods=["POST"])
+@login_required
+def create_upload_session():
+    """Start a chunked upload. Body: filename, size, caption, type."""
+    data = request.get_json(silent=True) or request.form
+    name = data.get("filename", ""); type_post = data.get("type", "post")
+    size = int(data["size"]) if str(data.get("size", "")).isdigit() else 0
+    if not allowed_file(name): return jsonify({"error": f"Invalid file type. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
+    if not 0 < size <= app.config["UPLOAD_SESSION_MAX_SIZE"]: return jsonify({"error": "Invalid file size"}), 400
+    if type_post not in ("post", "story"): return jsonify({"error": "Invalid type"}), 400
+    session_id, now, u, caption = uuid.uuid4().hex, datetime.utcnow().isoformat(), session["user"], data.get("caption", "")
+    open(session_part_path(session_id), "wb").close()
+    def start(db):
+        purge_upload_sessions(db, limit=50)
+        db.execute("INSERT INTO upload_sessions (id,username,ext,size,caption,type,created_at,updated_at) VALUES (?,?,?,?,?,?,?,?)",
+                   (session_id, u, name.rsplit(".", 1)[1].lower(), size, caption, type_post, now, now))
+    write(start)
+    return jsonify({"id": session_id, "offset": 0, "size": size, "chunk_size": app.config["UPLOAD_CHUNK_SIZE"]}), 201
+
+@app.route("/upload/session/<session_id>", methods=["GET"])
+@login_required
+def upload_session_status(session_id):
+    """Where to resume: the number of bytes the server has durably received."""
+    row = get_upload_session(session_id)
+    if not row: return jsonify({"error": "Upload session not found"}), 404
+    return jsonify({"id": session_id, "offset": row["received"], "size": row["size"], "chunk_size": app.config["UPLOAD_CHUNK_SIZE"]})
+
+@app.route("/upload/session/<session_id>", methods=["PUT"])
+@login_required
+def upload_chunk(session_id):
+    """Append one chunk. `?offset=` must equal the bytes received so far;
+    an optional X-Chunk-SHA256 header is verified before the chunk counts."""
+    row = get_upload_session(session_id)
+    if not row: return jsonify({"error": "Upload session not found"}), 404
+    offset = request.args.get("offset", type=int)
+    if (request.content_length or 0) > app.config["UPLOAD_CHUNK_MAX"] or (offset or 0) + (request.content_length or 0) > row["size"]:
+        return jsonify({"error": "Chunk too large", "offset": row["received"]}), 413
+    try:
+        part = open(session_part_path(session_id), "r+b")
+    except FileNotFoundError:
+        return jsonify({"error": "Upload session not found"}), 404
+    with part:
+        if not lock_part_file(part):
+            return jsonify({"error": "Another chunk is in progress", "offset": row["received"]}), 409
+        row = get_upload_session(session_id)  # re-read under the lock: a concurrent retry may have moved it on
+        if not row: return jsonify({"error": "Upload session not found"}), 404
+        if offset != row["received"]:
+            return jsonify({"error": "Offset mismatch", "offset": row["received"]}), 409
+        written = append_chunk(part, offset, request.stream, request.headers.get("X-Chunk-SHA256"))
+        if written is None:
+            return jsonify({"error": "Chunk checksum mismatch", "offset": offset}), 400
+        if offset + written > row["size"]:
+            part.truncate(offset)
+            return jsonify({"error": "Chunk too large", "offset": offset}), 413
+        received = offset + written
+        if not write(lambda db: db.execute("UPDATE upload_sessions SET received=?, updated_at=? WHERE id=? AND received=?",
+                                           (received, datetime.utcnow().isoformat(), session_id, offset)).rowcount):
+            part.truncate(offset)
+            return jsonify({"error": "Upload session not found"}), 404
+    return jsonify({"offset": received, "size": row["size"]})
+
+@app.route("/upload/session/<session_id>/complete", methods=["POST"])
+@login_required
+def complete_upload_session(session_id):
+    """Hash the assembled file and turn it into a post in one write transaction."""
+    row = get_upload_session(session_id)
+    if not row: return jsonify({"error": "Upload session not found"}), 404
+    if row["received"] != row["size"]:
+        return jsonify({"error": "Upload incomplete", "offset": row["received"]}), 409
+    path = session_part_path(session_id)
+    try:
+        part = open(path, "rb")
+    except FileNotFoundError:
+        return jsonify({"error": "Upload session not found"}), 404
+    with part:
+        if not lock_part_file(part):
+            return jsonify({"error": "A chunk is still being written", "offset": row["received"]}), 409
+        digest = hash_file(path)  # every chunk was checked on arrival
+        def finish(db):
+            if not db.execute("DELETE FROM upload_sessions WHERE id=? AND received=size", (session_id,)).rowcount:
+                return None
+            return create_post(db, row["username"], store_blob(db, digest, row["size"], row["ext"]), row["caption"], row["type"])
+        result = write(finish)
+        if result is not None:
+            place_blob(path, result[0])
+    if result is None: return jsonify({"error": "Upload session not found"}), 404
+    filename, kind = result
+    if kind: queue_media(filename, kind)
+    return jsonify({"success": True, "filename": filename, "redirect": url_for("index")})
+
 @app.route("/delete_story/<int:story_id>", methods=["POST"])
 @login_required
 def delete_story(story_id):
-    db = get_db(); u=session["user"]
-    story = db.execute("SELECT * FROM posts WHERE id=? AND type='story'",(story_id,)).fetchone()
-    if story and story["username"]==u: db.execute("DELETE FROM posts WHERE id=?",(story_id,)); db.commit(); return jsonify({"success":True})
+    u=session["user"]
+    if write(lambda db: delete_posts(db, "id=? AND type='story' AND username=?", (story_id, u))):
+        return jsonify({"success":True})
     return jsonify({"success":False,"error":"Not authorized"})
 
+@app.route("/post/<int:post_id>/status")
+@login_required
+def post_status(post_id):
+    """Media processing state of a post, polled by the client while a video transcodes."""
+    row = get_db().execute("SELECT p.filename, m.status, m.poster, m.playback, m.duration FROM posts p LEFT JOIN media m ON m.filename=p.filename WHERE p.id=?", (post_id,)).fetchone()
+    if not row: return jsonify({"error":"Post not found"}),404
+    out = {"status": row["status"] or "ready", "duration": row["duration"]}
+    if row["status"] == "ready" and row["playback"]:
+        out.update(src=url_for("uploaded_file", filename=row["playback"]), poster=url_for("uploaded_file", filename=row["poster"]))
+    elif row["status"] != "pending":
+        out["src"] = url_for("uploaded_file", filename=row["filename"])
+    return jsonify(out)
+
 # ==========================
 # Profile / Edit
 # ==========================
 @app.route("/profile/<username>", methods=["GET","POST"])
 @login_required
 def profile(username):
-    db=get_db(); u=db.execute("SELECT * FROM users WHERE username=?",(username,)).fetchone()
-    if not u: flash("User not found"); return redirect(url_for("index"))
-    followers_count = db.execute("SELECT COUNT(*) FROM followers WHERE username=?",(username,)).fetchone()[0]
-    following_count = db.execute("SELECT COUNT(*) FROM followers WHERE follower=?",(username,)).fetchone()[0]
+    db=get_db()
+    def load():
+        row=db.execute("SELECT * FROM users WHERE username=?",(username,)).fetchone()
+        if not row: return None
+        posts=db.execute(f"SELECT p.*, {MEDIA_COLUMNS} FROM posts p LEFT JOIN media m ON m.filename=p.filename WHERE p.username=? ORDER BY p.created_at DESC",(username,)).fetchall()
+        pic=db.execute("SELECT variants FROM media WHERE filename=?",(row["profile_pic"],)).fetchone()
+        return {"user": dict(row), "posts": [dict(p) for p in posts], "pic_variants": pic["variants"] if pic else ""}
+    cached_profile = cached(f"profile:{username}", [f"user:{username}"], load)
+    if not cached_profile: flash("User not found"); return redirect(url_for("index"))
+    u = cached_profile["user"]
+    followers_count, following_count = u["followers_count"], u["following_count"]
     is_following=False
     if username!=session["user"]: is_following=bool(db.execute("SELECT 1 FROM followers WHERE username=? AND follower=?",(username,session["user"])).fetchone())
     if request.method=="POST" and username==session["user"]:
         bio=request.form.get("bio",""); pic_file=request.files.get("profile_pic")
-        if pic_file and allowed_file(pic_file.filename): filename=safe_save_file(pic_file); db.execute("UPDATE users SET profile_pic=? WHERE username=?",(filename,username))
-        db.execute("UPDATE users SET bio=? WHERE username=?",(bio,username)); db.commit(); flash("Profile updated"); return redirect(url_for("profile",username=username))
-    posts=db.execute("SELECT * FROM posts WHERE username=? ORDER BY created_at DESC",(username,)).fetchall()
-    return render_template("profile.html", user=session["user"], profile=u, posts=posts, followers_count=followers_count, following_count=following_count, is_following=is_following)
+        def record(db, filename=None):
+            if filename:
+                old=db.execute("SELECT profile_pic FROM users WHERE username=?",(username,)).fetchone()
+                release_blob(db, old["profile_pic"])
+                db.execute("UPDATE users SET profile_pic=? WHERE username=?",(filename,username))
+            db.execute("UPDATE users SET bio=? WHERE username=?",(bio,username))
+            bump(db, f"user:{username}", "users")
+            return filename, filename and register_media(db, filename)
+        if pic_file and allowed_file(pic_file.filename): filename, kind = safe_save_file(pic_file, record)
+        else: filename, kind = write(record)
+        if kind: queue_media(filename, kind)
+        flash("Profile updated"); return redirect(url_for("profile",username=username))
+    return render_template("profile.html", user=session["user"], profile=u, posts=cached_profile["posts"], profile_pic_variants=cached_profile["pic_variants"], followers_count=followers_count, following_count=following_count, is_following=is_following)
 
 # ==========================
 # Likes / Comments
@@ -345,11 +2359,22 @@ def profile(username):
 @app.route("/like/<int:post_id>", methods=["POST"])
 @login_required
 def like_post(post_id):
-    db=get_db(); u=session["user"]
-    exists=db.execute("SELECT 1 FROM likes WHERE post_id=? AND username=?",(post_id,u)).fetchone()
-    if exists: db.execute("DELETE FROM likes WHERE post_id=? AND username=?",(post_id,u)); liked=False
-    else: db.execute("INSERT INTO likes (post_id,username,created_at) VALUES (?,?,?)",(post_id,u,datetime.utcnow().isoformat())); liked=True
-    db.commit(); like_count=db.execute("SELECT COUNT(*) FROM likes WHERE post_id=?",(post_id,)).fetchone()[0]
+    u=session["user"]
+    want=request.form.get("liked")  # "1"/"0" sets the state instead of toggling, so queued likes replay safely
+    def toggle(db):
+        post=db.execute("SELECT username FROM posts WHERE id=?",(post_id,)).fetchone()
+        if not post: return None
+        if want!="1" and db.execute("DELETE FROM likes WHERE post_id=? AND username=?",(post_id,u)).rowcount: delta=-1; liked=False
+        elif want=="0": delta=0; liked=False
+        else: delta=db.execute("INSERT OR IGNORE INTO likes (post_id,username,created_at) VALUES (?,?,?)",(post_id,u,datetime.utcnow().isoformat())).rowcount; liked=True
+        if delta: bump(db, f"post:{post_id}")
+        unread=notify(db, post["username"], u, "like", post_id) if delta>0 else None
+        return liked, db.execute("UPDATE posts SET like_count=like_count+? WHERE id=? RETURNING like_count",(delta,post_id)).fetchone()[0], post["username"], unread
+    result=write(toggle)
+    if result is None: return jsonify({'error':'Post not found'}),404
+    liked, like_count, owner, unread = result
+    publish_counts(post_id, like_count=like_count)
+    publish_unread(owner, unread)
     return jsonify({'liked':liked,'like_count':like_count})
 
 @app.route("/comment/<int:post_id>", methods=["POST"])
@@ -357,29 +2382,44 @@ def like_post(post_id):
 def comment_post(post_id):
     text=request.form.get("comment","").strip(); 
     if not text: return jsonify({'error':'Empty comment'}),400
-    db=get_db()
-    db.execute("INSERT INTO comments (post_id,username,text,created_at) VALUES (?,?,?,?)",(post_id,session["user"],text,datetime.utcnow().isoformat()))
-    db.commit()
-    comment_id=db.execute("SELECT last_insert_rowid()").fetchone()[0]
-    return jsonify({'id':comment_id,'username':session["user"],'text':text})
+    u=session["user"]; key=request.form.get("client_key") or None
+    def add(db):
+        if key:
+            dup=db.execute("SELECT c.id, p.comment_count FROM comments c JOIN posts p ON p.id=c.post_id WHERE c.username=? AND c.client_key=?",(u,key)).fetchone()
+            if dup: return (*dup, None, None)
+        row=db.execute("UPDATE posts SET comment_count=comment_count+1 WHERE id=? RETURNING comment_count, username",(post_id,)).fetchone()
+        if not row: return None
+        bump(db, f"post:{post_id}")
+        comment_id=db.execute("INSERT INTO comments (post_id,username,text,created_at,client_key) VALUES (?,?,?,?,?)",(post_id,u,text,datetime.utcnow().isoformat(),key)).lastrowid
+        return comment_id, row["comment_count"], row["username"], notify(db, row["username"], u, "comment", post_id, text)
+    result=write(add)
+    if result is None: return jsonify({'error':'Post not found'}),404
+    comment_id, comment_count, owner, unread = result
+    publish_counts(post_id, comment_count=comment_count)
+    publish_unread(owner, unread)
+    return jsonify({'id':comment_id,'username':session["user"],'text':text,'comment_count':comment_count})
 
 @app.route("/delete_post/<int:post_id>", methods=["POST"])
 @login_required
 def delete_post(post_id):
-    db=get_db(); u=session["user"]; post=db.execute("SELECT * FROM posts WHERE id=?",(post_id,)).fetchone()
-    if post and post["username"]==u:
-        db.execute("DELETE FROM posts WHERE id=?",(post_id,))
-        db.execute("DELETE FROM likes WHERE post_id=?",(post_id,))
-        db.execute("DELETE FROM comments WHERE post_id=?",(post_id,))
-        db.commit()
+    u=session["user"]
+    if write(lambda db: delete_posts(db, "id=? AND username=?", (post_id, u))):
         return jsonify({'success':True})
     return jsonify({'success':False,'error':'Not authorized'})
 
 @app.route("/delete_comment/<int:comment_id>", methods=["POST"])
 @login_required
 def delete_comment(comment_id):
-    db=get_db(); u=session["user"]; comment=db.execute("SELECT * FROM comments WHERE id=?",(comment_id,)).fetchone()
-    if comment and comment["username"]==u: db.execute("DELETE FROM comments WHERE id=?",(comment_id,)); db.commit(); return jsonify({'success':True})
+    u=session["user"]
+    def remove(db):
+        comment=db.execute("DELETE FROM comments WHERE id=? AND username=? RETURNING post_id",(comment_id,u)).fetchone()
+        if not comment: return False
+        bump(db, f"post:{comment['post_id']}")
+        return db.execute("UPDATE posts SET comment_count=comment_count-1 WHERE id=? RETURNING id, comment_count",(comment["post_id"],)).fetchone() or True
+    row=write(remove)
+    if row:
+        if row is not True: publish_counts(row["id"], comment_count=row["comment_count"])
+        return jsonify({'success':True})
     return jsonify({'success':False,'error':'Not authorized'})
 
 @app.route("/edit_comment/<int:comment_id>", methods=["POST"])
@@ -387,8 +2427,12 @@ def delete_comment(comment_id):
 def edit_comment(comment_id):
     new_text=request.form.get("text","").strip(); 
     if not new_text: return jsonify({"success":False,"error":"Empty comment"})
-    db=get_db(); u=session["user"]; comment=db.execute("SELECT * FROM comments WHERE id=?",(comment_id,)).fetchone()
-    if comment and comment["username"]==u: db.execute("UPDATE comments SET text=? WHERE id=?",(new_text,comment_id)); db.commit(); return jsonify({"success":True,"text":new_text})
+    u=session["user"]
+    def edit(db):
+        row=db.execute("UPDATE comments SET text=? WHERE id=? AND username=? RETURNING post_id",(new_text,comment_id,u)).fetchone()
+        if row: bump(db, f"post:{row['post_id']}")
+        return bool(row)
+    if write(edit): return jsonify({"success":True,"text":new_text})
     return jsonify({"success":False,"error":"Not authorized"})
 
 # ==========================
@@ -397,10 +2441,19 @@ def edit_comment(comment_id):
 @app.route("/follow/<username>")
 @login_required
 def follow_user(username):
-    db=get_db(); u=session["user"]; exists=db.execute("SELECT 1 FROM followers WHERE username=? AND follower=?",(username,u)).fetchone()
-    if exists: db.execute("DELETE FROM followers WHERE username=? AND follower=?",(username,u))
-    else: db.execute("INSERT INTO followers (username,follower,created_at) VALUES (?,?,?)",(username,u,datetime.utcnow().isoformat()))
-    db.commit(); return redirect(request.referrer or url_for("profile",username=username))
+    u=session["user"]
+    if not user_exists(username): flash("User not found"); return redirect(url_for("index"))
+    def toggle(db):
+        if db.execute("DELETE FROM followers WHERE username=? AND follower=?",(username,u)).rowcount:
+            delta=-1; db.execute("DELETE FROM timeline WHERE owner=? AND author=? AND author!=owner",(u,username))
+        else:
+            delta=db.execute("INSERT OR IGNORE INTO followers (username,follower,created_at) VALUES (?,?,?)",(username,u,datetime.utcnow().isoformat())).rowcount
+            if delta: backfill_timeline(db, u, username)
+        db.execute("UPDATE users SET followers_count=followers_count+? WHERE username=?",(delta,username))
+        db.execute("UPDATE users SET following_count=following_count+? WHERE username=?",(delta,u))
+        bump(db, f"user:{username}", f"user:{u}")
+        return notify(db, username, u, "follow") if delta>0 else None
+    publish_unread(username, write(toggle)); return redirect(request.referrer or url_for("profile",username=username))
 
 @app.route("/feedback", methods=["GET","POST"])
 @login_required
@@ -408,15 +2461,171 @@ def feedback():
     db=get_db(); user=session.get("user") or "Anonymous"
     if request.method=="POST":
         action=request.form.get("action"); fid=request.form.get("id"); msg=request.form.get("message","").strip()
-        if action=="add" and msg: db.execute("INSERT INTO feedback (name,message,created_at) VALUES (?,?,?)",(user,msg,datetime.utcnow().isoformat()))
-        elif action=="edit" and fid and msg: db.execute("UPDATE feedback SET message=? WHERE id=? AND name=?",(msg,fid,user))
-        elif action=="delete" and fid: db.execute("DELETE FROM feedback WHERE id=? AND name=?",(fid,user))
-        db.commit()
-        feedbacks=db.execute("SELECT id,name,message FROM feedback ORDER BY created_at DESC").fetchall()
-        return jsonify([{"id":f["id"],"name":f["name"],"message":f["message"]} for f in feedbacks])
-    feedbacks=db.execute("SELECT id,name,message FROM feedback ORDER BY created_at DESC").fetchall()
+        def apply(db):
+            if action=="add" and msg: db.execute("INSERT INTO feedback (name,message,created_at) VALUES (?,?,?)",(user,msg,datetime.utcnow().isoformat()))
+            elif action=="edit" and fid and msg: db.execute("UPDATE feedback SET message=? WHERE id=? AND name=?",(msg,fid,user))
+            elif action=="delete" and fid: db.execute("DELETE FROM feedback WHERE id=? AND name=?",(fid,user))
+            bump(db, "feedback")
+        write(apply)
+    feedbacks=cached("feedback", ["feedback"], lambda: [{"id":f["id"],"name":f["name"],"message":f["message"]} for f in db.execute("SELECT id,name,message FROM feedback ORDER BY created_at DESC")])
+    if request.method=="POST":
+        return jsonify(feedbacks)
     return render_template("feedback.html", feedbacks=feedbacks, user=user)
 
+# ==========================
+# Notifications
+# ==========================
+@app.route("/notifications")
+@login_required
+def notifications():
+    u = session["user"]
+    items, next_cursor = fetch_notifications(get_db(), u, request.args.get("cursor"))
+    if any(not n["read"] for n in items):
+        mark_notifications_read(u)  # the page still highlights what was new
+    return render_template("notifications.html", user=u, notifications=items, next_cursor=next_cursor)
+
+@app.route("/notifications/count")
+@login_required
+def notifications_count():
+    row = get_db().execute("SELECT unread_notifications FROM users WHERE username=?", (session["user"],)).fetchone()
+    return jsonify({"unread": row[0] if row else 0})
+
+@app.route("/notifications/read", methods=["POST"])
+@login_required
+def notifications_read():
+    mark_notifications_read(session["user"])
+    return jsonify({"unread": 0})
+
+# ==========================
+# JSON API
+# ==========================
+# Compact JSON for the PWA and polling clients. Every response carries a weak
+# ETag built from the rows it is made of plus the post:<id>/user:<name>
+# cache versions, so an unchanged refresh costs one indexed query and a 304.
+API_POST_FIELDS = {"id", "username", "avatar", "caption", "type", "created_at", "like_count", "comment_count", "liked", "media", "comments"}
+API_DEFAULT_FIELDS = API_POST_FIELDS - {"comments"}
+
+def api_fields(default):
+    """The post fields requested with ?fields=a,b,c; aborts with 400 on unknown names."""
+    raw = request.args.get("fields")
+    if not raw:
+        return default
+    fields = {f.strip() for f in raw.split(",") if f.strip()}
+    unknown = fields - API_POST_FIELDS
+    if unknown:
+        abort(Response(json.dumps({"error": f"Unknown field(s): {', '.join(sorted(unknown))}"}), 400, mimetype="application/json"))
+    return fields | {"id"}
+
+def api_limit():
+    return max(1, min(request.args.get("limit", app.config["FEED_PAGE_SIZE"], type=int), app.config["API_MAX_PAGE_SIZE"]))
+
+def api_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+def api_response(etag, build):
+    """304 if the client already has `etag`; otherwise jsonify(build()) tagged with it."""
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag, weak=True)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True  # always revalidate; a 304 is nearly free
+    return resp
+
+def post_versions(posts):
+    return cache_versions(f"post:{p['id']}" for p in posts)
+
+def api_post(p, fields, viewer):
+    """One post as a dict holding only `fields`; empty values are dropped."""
+    out = {k: p[k] for k in ("id", "username", "caption", "type", "created_at", "like_count", "comment_count") if k in fields}
+    if "liked" in fields:
+        out["liked"] = bool(p["liked"])
+    if "avatar" in fields and p.get("profile_pic"):
+        out["avatar"] = url_for("uploaded_file", filename=p["profile_pic"])
+    if "media" in fields:
+        item = {"url": media_url(p["filename"], p["variants"]), "thumb": media_url(p["filename"], p["variants"], 320),
+                "kind": "video" if media.is_video(p["filename"]) else "image", "status": p["media_status"],
+                "width": p["width"], "height": p["height"],
+                "poster": p["poster"] and url_for("uploaded_file", filename=p["poster"]),
+                "playback": p["playback"] and url_for("uploaded_file", filename=p["playback"])}
+        out["media"] = {k: v for k, v in item.items() if v is not None}
+    if "comments" in fields:
+        out["comments"] = [comment_dict(c, viewer) for c in p["comments"]]
+        if p["comments_cursor"]:
+            out["comments_cursor"] = p["comments_cursor"]
+    return out
+
+def api_page(db, posts, next_cursor, fields, viewer, etag_parts=(), extra=None):
+    etag = api_etag(sorted(fields), next_cursor, [tuple(p.values()) for p in posts], post_versions(posts), *etag_parts)
+    def build():
+        if "comments" in fields:
+            attach_latest_comments(db, posts, app.config["FEED_COMMENTS_PER_POST"])
+        return {**(extra or {}), "posts": [api_post(p, fields, viewer) for p in posts], "next_cursor": next_cursor}
+    return api_response(etag, build)
+
+@app.route("/api/feed")
+@login_required
+def api_feed():
+    db, u = get_db(), session["user"]
+    posts, next_cursor = fetch_feed_page(db, u, request.args.get("cursor"), api_limit())
+    return api_page(db, posts, next_cursor, api_fields(API_DEFAULT_FIELDS), u)
+
+@app.route("/api/profile/<username>")
+@login_required
+def api_profile(username):
+    db, u = get_db(), session["user"]
+    user = db.execute("SELECT username, bio, profile_pic, followers_count, following_count FROM users WHERE username=?", (username,)).fetchone()
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+    limit, after = api_limit(), decode_cursor(request.args.get("cursor"))
+    keyset, page = "", []
+    if after:
+        keyset, page = " AND (p.created_at<? OR (p.created_at=? AND p.id<?))", [after[0], after[0], after[1]]
+    rows = db.execute(f"""
+        SELECT p.*, ? AS profile_pic, {MEDIA_COLUMNS},
+               EXISTS(SELECT 1 FROM likes l WHERE l.post_id=p.id AND l.username=?) AS liked
+        FROM posts p LEFT JOIN media m ON m.filename=p.filename
+        WHERE p.username=? AND p.type='post'{keyset}
+        ORDER BY p.created_at DESC, p.id DESC LIMIT ?
+    """, (user["profile_pic"], u, username, *page, limit + 1)).fetchall()
+    posts = [dict(r) for r in rows[:limit]]
+    next_cursor = encode_cursor(posts[-1]["created_at"], posts[-1]["id"]) if len(rows) > limit else None
+    following = username != u and bool(db.execute("SELECT 1 FROM followers WHERE username=? AND follower=?", (username, u)).fetchone())
+    profile = {"username": user["username"], "bio": user["bio"], "avatar": url_for("uploaded_file", filename=user["profile_pic"]),
+               "followers_count": user["followers_count"], "following_count": user["following_count"], "is_following": following}
+    return api_page(db, posts, next_cursor, api_fields(API_DEFAULT_FIELDS), u,
+                    etag_parts=(tuple(profile.values()),), extra={"user": profile})
+
+@app.route("/api/post/<int:post_id>")
+@login_required
+def api_post_detail(post_id):
+    db, u = get_db(), session["user"]
+    row = db.execute(f"""
+        SELECT p.*, u.profile_pic, {MEDIA_COLUMNS},
+               EXISTS(SELECT 1 FROM likes l WHERE l.post_id=p.id AND l.username=?) AS liked
+        FROM posts p LEFT JOIN users u ON u.username=p.username LEFT JOIN media m ON m.filename=p.filename
+        WHERE p.id=?
+    """, (u, post_id)).fetchone()
+    if not row:
+        return jsonify({"error": "Post not found"}), 404
+    post, fields = dict(row), api_fields(API_POST_FIELDS)
+    etag = api_etag(sorted(fields), tuple(post.values()), post_versions([post]))
+    def build():
+        if "comments" in fields:
+            attach_latest_comments(db, [post], app.config["COMMENTS_PAGE_SIZE"])
+        return api_post(post, fields, u)
+    return api_response(etag, build)
+
+@app.route("/api/notifications")
+@login_required
+def api_notifications():
+    db, u = get_db(), session["user"]
+    items, next_cursor = fetch_notifications(db, u, request.args.get("cursor"), api_limit())
+    unread = db.execute("SELECT unread_notifications FROM users WHERE username=?", (u,)).fetchone()
+    etag = api_etag(unread and unread[0], next_cursor, [(n["id"], n["updated_at"], n["actor_count"], n["read"]) for n in items])
+    return api_response(etag, lambda: {"unread": unread[0] if unread else 0, "notifications": items, "next_cursor": next_cursor})
+
 # ==========================
 # Errors
 # ==========================
@@ -0,0 +1,216 @@
+# ================== BENCH_HARNECT.PY ==================
+"""
+Benchmark the main HARNECT routes through Flask's test client.
+
+For every route it reports p50/p95/p99 latency, SQL statements per request
+and single-client throughput, then compares against a stored baseline so
+regressions show up before a change ships. Run it against a database made
+by seed_harnect.py; write routes (likes, comments) modify that database.
+
+Usage:
+    python seed_harnect.py --db bench.db
+    python bench_harnect.py --db bench.db --save-baseline     # record
+    python bench_harnect.py --db bench.db                     # compare
+
+bench_baseline.json is the committed reference, recorded on a default
+`python seed_harnect.py` database. Re-record it in the same commit as a
+change that is meant to move the numbers.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+
+IGNORED_SQL = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+# Trigger bodies are traced as "-- ..." and FTS5 reads its shadow tables through
+# "'main'.'users_fts_data'"-style statements; neither is a query the route issued.
+NESTED_SQL = re.compile(r"^\s*--|'main'\.'")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", default=os.environ.get("HARNECT_DATABASE", "harnect_seed.db"))
+    p.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    p.add_argument("--warmup", type=int, default=20)
+    p.add_argument("--threads", type=int, default=1, help="concurrent clients per route")
+    p.add_argument("--routes", help="comma-separated subset of route names")
+    p.add_argument("--cache", default=None, help="cache backend override: memory, sqlite or none")
+    p.add_argument("--baseline", default="bench_baseline.json")
+    p.add_argument("--save-baseline", action="store_true")
+    p.add_argument("--tolerance", type=float, default=0.20, help="allowed p95 slowdown vs. baseline (0.2 = 20%%)")
+    p.add_argument("--fail-on-regression", action="store_true")
+    return p.parse_args()
+
+
+class QueryCounter:
+    """Counts SQL statements on every connection the app opens."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, sql):
+        if not sql.lstrip().upper().startswith(IGNORED_SQL) and not NESTED_SQL.search(sql):
+            with self._lock:
+                self.count += 1
+
+    def install(self, harnect):
+        connect = harnect.connect_db
+
+        def traced(**kwargs):
+            db = connect(**kwargs)
+            db.set_trace_callback(self)
+            return db
+        harnect.connect_db = traced
+
+
+def seed_upload_folder(db_path):
+    """Where seed_harnect.py puts the media for `db_path`: <name>_uploads beside it."""
+    return os.path.splitext(os.path.abspath(db_path))[0] + "_uploads"
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def build_routes(harnect):
+    """(name, method, url-or-callable, viewer) for the routes we care about."""
+    db = harnect.connect_db()
+    one = lambda sql, *a: (db.execute(sql, a).fetchone() or [None])[0]
+    star = one("SELECT username FROM users WHERE guest=0 ORDER BY followers_count DESC LIMIT 1")
+    viewer = one("SELECT username FROM users WHERE guest=0 ORDER BY following_count DESC LIMIT 1") or star
+    hot_post = one("SELECT id FROM posts WHERE type='post' ORDER BY comment_count DESC LIMIT 1")
+    recent = [r[0] for r in db.execute("SELECT id FROM posts WHERE type='post' ORDER BY created_at DESC LIMIT 10")]
+    word = (one("SELECT caption FROM posts WHERE type='post' ORDER BY like_count DESC LIMIT 1") or "sunset").split()[0].lower()
+    db.close()
+    if not star or not hot_post:
+        sys.exit("The database has no users/posts; run seed_harnect.py first.")
+    second_page = lambda client: "/index?partial=1&cursor=" + client.get("/index?partial=1").get_data(as_text=True).split('data-next-cursor="')[-1].split('"')[0]
+    return [
+        ("home", "GET", "/index", viewer),
+        ("home_page2", "GET", second_page, viewer),
+        ("explore", "GET", "/explore", viewer),
+        ("search", "GET", f"/explore?query={word}", viewer),
+        ("suggest", "GET", f"/search/suggest?q={star[:4]}", viewer),
+        ("profile", "GET", f"/profile/{star}", viewer),
+        ("comments", "GET", f"/comments/{hot_post}", viewer),
+        ("like_counts", "GET", "/like-counts?ids=" + ",".join(map(str, recent)), viewer),
+        ("feedback", "GET", "/feedback", viewer),
+        ("like", "POST", f"/like/{hot_post}", viewer),
+        ("comment", "POST", f"/comment/{hot_post}", viewer),
+    ]
+
+
+def run_route(harnect, counter, route, args):
+    name, method, target, viewer = route
+    clients = []
+    for _ in range(args.threads):
+        client = harnect.app.test_client()
+        with client.session_transaction() as s:
+            s["user"] = viewer
+        # Resolve callable targets (e.g. a page-2 cursor) once, outside the timed loop.
+        clients.append((client, target(client) if callable(target) else target))
+
+    def hit(client, url):
+        if method == "POST":
+            resp = client.post(url, data={"comment": "benchmark comment"})
+        else:
+            resp = client.get(url)
+        resp.close()
+        if resp.status_code >= 400:
+            raise RuntimeError(f"{name}: {method} {url} -> {resp.status_code}")
+
+    for _ in range(args.warmup):
+        hit(*clients[0])
+
+    latencies, per_thread = [], max(args.requests // args.threads, 1)
+    lock = threading.Lock()
+
+    def worker(client, url):
+        local = []
+        for _ in range(per_thread):
+            t0 = time.perf_counter()
+            hit(client, url)
+            local.append((time.perf_counter() - t0) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    queries_before = counter.count
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=c) for c in clients]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "queries_per_req": round((counter.count - queries_before) / len(latencies), 2),
+        "rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the results table; returns the names of routes slower than the baseline allows."""
+    regressions = []
+    print(f"{'route':<12} {'p50':>8} {'p95':>8} {'p99':>8} {'q/req':>6} {'req/s':>8}   vs. baseline p95")
+    for name, r in results.items():
+        base = baseline.get(name)
+        note = ""
+        if base:
+            change = (r["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0
+            note = f"{change:+.0%}"
+            if change > tolerance:
+                note += "  << REGRESSION"
+                regressions.append(name)
+            if r["queries_per_req"] > base["queries_per_req"]:
+                note += f"  (queries {base['queries_per_req']} -> {r['queries_per_req']})"
+        print(f"{name:<12} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['queries_per_req']:>6} {r['rps']:>8.1f}   {note}")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    os.environ["HARNECT_DATABASE"] = os.path.abspath(args.db)
+    os.environ.setdefault("HARNECT_UPLOAD_FOLDER", seed_upload_folder(args.db))
+    os.environ["HARNECT_MAINTENANCE_MODE"] = "external"   # keep background jobs out of the numbers
+    os.environ["HARNECT_VIDEO_WORKER_MODE"] = "external"
+    if args.cache:
+        os.environ["HARNECT_CACHE"] = args.cache
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as harnect
+
+    harnect.app.config["TESTING"] = True
+    counter = QueryCounter()
+    counter.install(harnect)
+
+    routes = build_routes(harnect)
+    if args.routes:
+        wanted = set(args.routes.split(","))
+        routes = [r for r in routes if r[0] in wanted]
+    results = {route[0]: run_route(harnect, counter, route, args) for route in routes}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f).get("routes", {})
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "db": os.path.basename(args.db),
+                       "requests": args.requests, "threads": args.threads, "routes": results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    if regressions and args.fail_on_regression:
+        sys.exit(f"p95 regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# ================== HARNECT_DUMP.PY ==================
+"""
+Export, import and back up a HARNECT database.
+
+    python harnect_dump.py export DIR [--gzip] [--verify-media]
+    python harnect_dump.py import DIR [--replace] [--verify-media]
+    python harnect_dump.py verify-media [--workers 8]
+    python harnect_dump.py backup harnect-backup.db
+
+export  Streams users, posts, followers, likes, comments and feedback to one
+        JSONL file per table, plus a manifest.json. All tables are read in
+        one read transaction, so the dump is a consistent snapshot, and in
+        WAL mode the app keeps writing while it runs.
+import  Loads such a dump with executemany in one transaction. Non-unique
+        indexes and the search triggers are dropped first and rebuilt at the
+        end, followed by the counters, timelines, search index and blob
+        reference counts. Stop the app (or import into a new file) first.
+verify-media
+        Checks that every uploaded file the database refers to exists and,
+        for content-addressed names, that its SHA-256 matches the name.
+        Files are hashed in parallel.
+backup  Copies the live database with SQLite's online backup API. The copy
+        reads from one pinned snapshot, so concurrent writes neither block
+        nor restart it.
+
+Memory use stays constant: rows are streamed through generators in
+--batch sized chunks.
+"""
+
+import argparse
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TABLES = ("users", "posts", "followers", "likes", "comments", "feedback")  # import order
+FORMAT = "harnect-jsonl"
+CONTENT_NAME = re.compile(r"^([0-9a-f]{64})\.[a-z0-9]+$")  # uploads named after their SHA-256
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", default=os.environ.get("HARNECT_DATABASE") or os.path.join(BASE_DIR, "harnect.db"))
+    p.add_argument("--uploads", default=os.environ.get("HARNECT_UPLOAD_FOLDER") or os.path.join(BASE_DIR, "static", "uploads"))
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="threads for media checksums")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    e = sub.add_parser("export", help="dump tables to JSONL")
+    e.add_argument("dir")
+    e.add_argument("--gzip", action="store_true", help="write .jsonl.gz files")
+    e.add_argument("--batch", type=int, default=5000)
+    e.add_argument("--verify-media", action="store_true")
+
+    i = sub.add_parser("import", help="load a JSONL dump")
+    i.add_argument("dir")
+    i.add_argument("--replace", action="store_true", help="delete existing rows first")
+    i.add_argument("--batch", type=int, default=5000, help="rows per executemany call")
+    i.add_argument("--verify-media", action="store_true")
+
+    sub.add_parser("verify-media", help="check uploaded files against the database")
+
+    b = sub.add_parser("backup", help="online copy of the database file")
+    b.add_argument("dest")
+    b.add_argument("--pages", type=int, default=1024, help="pages copied per step")
+    b.add_argument("--throttle", type=float, default=0.0, help="seconds to pause between steps")
+    return p.parse_args()
+
+
+def chunks(rows, size):
+    it = iter(rows)
+    while batch := list(itertools.islice(it, size)):
+        yield batch
+
+
+def open_text(path, mode, compressed):
+    return gzip.open(path, mode + "t", encoding="utf-8") if compressed else open(path, mode, encoding="utf-8")
+
+
+# ---------------------------
+# Export
+# ---------------------------
+def stream_rows(db, table, batch):
+    cur = db.execute(f"SELECT * FROM {table} ORDER BY rowid")
+    columns = [d[0] for d in cur.description]
+    yield columns
+    while rows := cur.fetchmany(batch):
+        for row in rows:
+            yield dict(zip(columns, row))
+
+
+def export(args):
+    os.makedirs(args.dir, exist_ok=True)
+    db = sqlite3.connect(args.db, isolation_level=None)
+    db.execute("BEGIN")  # one read snapshot for every table; writers are not blocked in WAL mode
+    manifest = {"format": FORMAT, "version": 1, "schema_version": db.execute("PRAGMA user_version").fetchone()[0],
+                "exported_at": datetime.utcnow().isoformat(), "tables": {}}
+    for table in TABLES:
+        name = f"{table}.jsonl" + (".gz" if args.gzip else "")
+        rows = stream_rows(db, table, args.batch)
+        columns, count = next(rows), 0
+        with open_text(os.path.join(args.dir, name + ".part"), "w", args.gzip) as out:
+            for row in rows:
+                out.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+                count += 1
+        os.replace(os.path.join(args.dir, name + ".part"), os.path.join(args.dir, name))
+        manifest["tables"][table] = {"file": name, "columns": columns, "rows": count}
+        print(f"{table:<10} {count:>10} rows")
+    db.execute("COMMIT")
+    with open(os.path.join(args.dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    if args.verify_media:
+        verify_media(db, args.uploads, args.workers)
+    db.close()
+    print(f"Exported to {args.dir}")
+
+
+# ---------------------------
+# Import
+# ---------------------------
+def read_rows(path, columns):
+    with open_text(path, "r", path.endswith(".gz")) as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                yield tuple(row.get(c) for c in columns)
+
+
+def deferred_schema(db):
+    """Non-unique indexes and triggers on the imported tables: (kind, name, sql).
+
+    Unique indexes stay, since they are what keeps a dump with duplicate
+    likes or follows from loading them.
+    """
+    rows = db.execute(f"""SELECT type, name, sql FROM sqlite_master
+                          WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+                          AND tbl_name IN ({','.join('?' * len(TABLES))})""", TABLES).fetchall()
+    return [(kind, name, sql) for kind, name, sql in rows if not (kind == "index" and sql.lstrip().upper().startswith("CREATE UNIQUE"))]
+
+
+def import_dump(args):
+    with open(os.path.join(args.dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT:
+        sys.exit(f"{args.dir} is not a {FORMAT} dump")
+
+    os.environ["HARNECT_DATABASE"] = os.path.abspath(args.db)
+    os.environ.setdefault("HARNECT_MAINTENANCE_MODE", "external")
+    os.environ.setdefault("HARNECT_VIDEO_WORKER_MODE", "external")
+    sys.path.insert(0, BASE_DIR)
+    import app as harnect  # migrates the target database on import
+
+    started = time.perf_counter()
+    db = harnect.connect_db(isolation_level=None)
+    db.execute("PRAGMA cache_size=-256000")
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        existing = {t: db.execute(f"SELECT EXISTS(SELECT 1 FROM {t})").fetchone()[0] for t in TABLES}
+        if any(existing.values()) and not args.replace:
+            sys.exit(f"{args.db} already has data ({', '.join(t for t, n in existing.items() if n)}); use --replace")
+
+        deferred = deferred_schema(db)
+        for kind, name, _ in deferred:
+            db.execute(f"DROP {kind.upper()} {name}")
+        if args.replace:
+            for table in (*reversed(TABLES), "timeline", "notification_actors", "notifications", "upload_sessions"):
+                db.execute(f"DELETE FROM {table}")
+
+        for table in TABLES:
+            spec = manifest["tables"].get(table)
+            if not spec:
+                continue
+            target = {r[1] for r in db.execute(f"PRAGMA table_info({table})")}
+            columns = [c for c in spec["columns"] if c in target]
+            sql = f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+            count = 0
+            for batch in chunks(read_rows(os.path.join(args.dir, spec["file"]), columns), args.batch):
+                db.executemany(sql, batch)
+                count += len(batch)
+            skipped = spec["rows"] - count
+            print(f"{table:<10} {count:>10} rows" + (f"  (manifest says {spec['rows']})" if skipped else ""))
+
+        print("Rebuilding indexes, counters, timelines and search...")
+        for _, _, sql in deferred:
+            db.execute(sql)
+        for fts in ("users_fts", "posts_fts"):
+            db.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        harnect.backfill_counters(db)
+        harnect.rebuild_timelines(db)
+        harnect.rebuild_blob_refcounts(db)
+        db.execute("UPDATE users SET unread_notifications=0")
+        harnect.bump(db, "posts", "users", "feedback")
+        db.execute("COMMIT")
+    except BaseException:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    db.execute("ANALYZE")
+    db.execute("PRAGMA optimize")
+    if args.verify_media:
+        verify_media(db, args.uploads, args.workers)
+    db.close()
+    print(f"Imported {args.dir} into {args.db} in {time.perf_counter() - started:.1f}s. "
+          "Run `flask media-backfill` to regenerate image variants for the imported files.")
+
+
+# ---------------------------
+# Media verification
+# ---------------------------
+def check_file(folder, name):
+    path = os.path.join(folder, name)
+    if not os.path.isfile(path):
+        return name, "missing"
+    match = CONTENT_NAME.match(name)
+    if not match:
+        return name, "exists"  # legacy uuid name: nothing to compare against
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)  # releases the GIL, so threads hash in parallel
+    return name, "ok" if digest.hexdigest() == match.group(1) else "mismatch"
+
+
+def bounded_map(pool, fn, items, window):
+    """pool.map() that keeps at most `window` tasks in flight, so memory stays flat."""
+    pending = []
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for fut in pending:
+        yield fut.result()
+
+
+def verify_media(db, folder, workers):
+    names = (r[0] for r in db.execute("""SELECT filename FROM posts WHERE filename IS NOT NULL
+                                         UNION SELECT profile_pic FROM users WHERE profile_pic IS NOT NULL AND profile_pic!='user.png'"""))
+    totals, bad = {}, []
+    with ThreadPoolExecutor(workers) as pool:
+        for name, status in bounded_map(pool, lambda n: check_file(folder, n), names, workers * 4):
+            totals[status] = totals.get(status, 0) + 1
+            if status in ("missing", "mismatch"):
+                bad.append(f"{status}: {name}")
+    for line in bad[:50]:
+        print(line)
+    if len(bad) > 50:
+        print(f"... and {len(bad) - 50} more")
+    print("media:", ", ".join(f"{n} {s}" for s, n in sorted(totals.items())) or "no files referenced")
+    return not bad
+
+
+# ---------------------------
+# Online backup
+# ---------------------------
+def backup(args):
+    src = sqlite3.connect(args.db, isolation_level=None)
+    wal = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+    if wal:
+        # Pin one snapshot: the backup then reads a fixed version of the
+        # database and is not restarted by the app's commits.
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    else:
+        print("Database is not in WAL mode: concurrent writes will restart the copy.")
+
+    tmp = args.dest + ".part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    dst = sqlite3.connect(tmp)
+    started = time.perf_counter()
+
+    def progress(status, remaining, total):
+        done = total - remaining
+        print(f"\r{done}/{total} pages ({done * 100 // max(total, 1)}%)", end="", flush=True)
+        if args.throttle:
+            time.sleep(args.throttle)
+
+    try:
+        src.backup(dst, pages=args.pages, progress=progress)
+    finally:
+        if wal:
+            src.execute("COMMIT")
+        src.close()
+    print()
+    dst.execute("PRAGMA journal_mode=DELETE")  # a single self-contained file
+    check = dst.execute("PRAGMA quick_check").fetchone()[0]
+    dst.close()
+    if check != "ok":
+        sys.exit(f"Backup failed quick_check: {check}")
+    os.replace(tmp, args.dest)
+    print(f"Backed up {args.db} to {args.dest} in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    args = parse_args()
+    if args.command == "export":
+        export(args)
+    elif args.command == "import":
+        import_dump(args)
+    elif args.command == "verify-media":
+        db = sqlite3.connect(args.db)
+        ok = verify_media(db, args.uploads, args.workers)
+        db.close()
+        sys.exit(0 if ok else 1)
+    elif args.command == "backup":
+        backup(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+HARNECT media helpers.
+
+Pure file-in/file-out functions used by the background media workers in
+app.py. Nothing here touches Flask or the database, so the functions are
+safe to run in worker threads or processes.
+"""
+
+import os
+import subprocess
+
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = {"png", "jpg", "jpeg"}
+VIDEO_EXTENSIONS = {"mp4", "webm", "ogg", "avi"}
+VARIANT_WIDTHS = (160, 320, 640, 1080)
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+VIDEO_MAX_HEIGHT = 720
+VIDEO_CRF = 23
+VIDEO_MAXRATE = "2500k"
+AUDIO_BITRATE = "128k"
+FFMPEG_TIMEOUT = 30 * 60  # seconds
+
+
+def is_image(filename):
+    return filename.rsplit(".", 1)[-1].lower() in IMAGE_EXTENSIONS
+
+
+def is_video(filename):
+    return filename.rsplit(".", 1)[-1].lower() in VIDEO_EXTENSIONS
+
+
+def variant_name(filename, width, fmt=None):
+    """Name of the `width`-pixel derivative of `filename`, e.g. abc_w320.webp.
+
+    `fmt` is "webp" for the WebP copy; by default the original's extension is kept.
+    """
+    stem, ext = filename.rsplit(".", 1)
+    return f"{stem}_w{width}.{'webp' if fmt == 'webp' else ext.lower()}"
+
+
+def _save_atomic(img, path, **params):
+    tmp = f"{path}.tmp"
+    img.save(tmp, **params)
+    os.replace(tmp, path)
+
+
+def make_image_variants(path, folder, widths=VARIANT_WIDTHS):
+    """Write resized, EXIF-free copies of the image at `path` into `folder`.
+
+    Each target width gets a copy in the original format plus a WebP copy.
+    Widths larger than the source collapse to the source width, so small
+    images still get one stripped copy. Returns (width, height, [widths]).
+    """
+    filename = os.path.basename(path)
+    ext = filename.rsplit(".", 1)[-1].lower()
+    with Image.open(path) as src:
+        # Bake the EXIF orientation into the pixels; metadata is not copied over.
+        img = ImageOps.exif_transpose(src)
+        width, height = img.size
+        made = sorted({min(w, width) for w in widths})
+        for w in made:
+            h = max(1, round(height * w / width))
+            resized = img.resize((w, h), Image.LANCZOS) if w != width else img.copy()
+            if ext == "png":
+                _save_atomic(resized, os.path.join(folder, variant_name(filename, w)), format="PNG", optimize=True)
+            else:
+                _save_atomic(resized.convert("RGB"), os.path.join(folder, variant_name(filename, w)),
+                             format="JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            alpha = resized.mode in ("RGBA", "LA") or "transparency" in resized.info
+            _save_atomic(resized.convert("RGBA" if alpha else "RGB"), os.path.join(folder, variant_name(filename, w, "webp")),
+                         format="WEBP", quality=WEBP_QUALITY, method=4)
+    return width, height, made
+
+
+def poster_name(filename):
+    return f"{filename.rsplit('.', 1)[0]}_poster.jpg"
+
+
+def playback_name(filename):
+    return f"{filename.rsplit('.', 1)[0]}_web.mp4"
+
+
+def _ffmpeg(*args):
+    import imageio_ffmpeg  # bundled static ffmpeg binary; only needed by video workers
+
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error", "-y", *args]
+    subprocess.run(cmd, check=True, capture_output=True, timeout=FFMPEG_TIMEOUT)
+
+
+def probe_video(path):
+    """Return (width, height, duration_seconds) read from the container header."""
+    import imageio_ffmpeg
+
+    frames = imageio_ffmpeg.read_frames(path)
+    try:
+        meta = next(frames)
+    finally:
+        frames.close()
+    width, height = meta.get("size") or (None, None)
+    return width, height, meta.get("duration")
+
+
+def process_video(path, folder):
+    """Extract a poster frame and transcode `path` to a web-friendly MP4.
+
+    The output is H.264/AAC, at most VIDEO_MAX_HEIGHT lines, capped at
+    VIDEO_MAXRATE, with the moov atom up front (faststart) so playback can
+    begin before the whole file has downloaded. Runs in a worker process.
+    Returns a dict with the poster and playback filenames plus the
+    source dimensions and duration.
+    """
+    filename = os.path.basename(path)
+    width, height, duration = probe_video(path)
+
+    poster = poster_name(filename)
+    seek = min(1.0, (duration or 0) / 2)
+    tmp = os.path.join(folder, f"{poster}.tmp.jpg")
+    _ffmpeg("-ss", f"{seek:.2f}", "-i", path, "-frames:v", "1",
+            "-vf", f"scale=-2:'min({VIDEO_MAX_HEIGHT},ih)'", "-q:v", "3", tmp)
+    os.replace(tmp, os.path.join(folder, poster))
+
+    playback = playback_name(filename)
+    tmp = os.path.join(folder, f"{playback}.tmp.mp4")
+    _ffmpeg("-i", path,
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", str(VIDEO_CRF),
+            "-maxrate", VIDEO_MAXRATE, "-bufsize", "5000k", "-pix_fmt", "yuv420p",
+            "-vf", f"scale=-2:'min({VIDEO_MAX_HEIGHT},ih)'",
+            "-c:a", "aac", "-b:a", AUDIO_BITRATE,
+            "-movflags", "+faststart", tmp)
+    os.replace(tmp, os.path.join(folder, playback))
+
+    return {"width": width, "height": height, "duration": duration, "poster": poster, "playback": playback}
+
+
+def derived_files(filename, variants=""):
+    """Every file the pipeline may have written for `filename` (not the original itself).
+
+    `variants` is the comma-separated width list stored in the media table.
+    """
+    names = [poster_name(filename), playback_name(filename)]
+    for w in (int(v) for v in (variants or "").split(",") if v):
+        names += [variant_name(filename, w), variant_name(filename, w, "webp")]
+    return names
@@ -0,0 +1,215 @@
+# ================== SEED_HARNECT.PY ==================
+"""
+Fill a HARNECT database with synthetic users, posts, stories, follows,
+likes and comments at production-like scale.
+
+Popularity is skewed the way real social graphs are: follows, likes and
+comments go to a few accounts far more often than the rest (Zipf-like
+weights), and recent posts collect more engagement than old ones.
+Rows are bulk-loaded with executemany in large transactions, then the
+counter columns and home timelines are rebuilt in one pass.
+
+Usage:
+    python seed_harnect.py --db bench.db --users 2000 --posts 20000
+
+Media goes to bench_uploads/ beside bench.db (override with HARNECT_UPLOAD_FOLDER).
+"""
+
+import argparse
+import hashlib
+import io
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+WORDS = ("sunset coffee travel friends weekend city beach mountains food music "
+         "lahore karachi islamabad cricket study code design family rain chai "
+         "morning night road trip campus art photo vibes happy throwback").split()
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--db", default=os.environ.get("HARNECT_DATABASE", "harnect_seed.db"), help="database file to create or extend")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--posts", type=int, default=10000)
+    p.add_argument("--stories", type=int, default=300)
+    p.add_argument("--follows", type=int, default=20000)
+    p.add_argument("--likes", type=int, default=50000)
+    p.add_argument("--comments", type=int, default=20000)
+    p.add_argument("--guests", type=int, default=0, help="guest accounts (for exercising maintenance)")
+    p.add_argument("--images", type=int, default=24, help="distinct placeholder images shared by the posts")
+    p.add_argument("--days", type=int, default=90, help="spread post timestamps over this many days")
+    p.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for popularity; 0 = uniform")
+    p.add_argument("--batch", type=int, default=5000, help="rows per executemany call")
+    p.add_argument("--seed", type=int, default=42)
+    return p.parse_args()
+
+
+def seed_upload_folder(db_path):
+    """<name>_uploads beside the seeded database; bench_harnect.py serves media from the same place."""
+    return os.path.splitext(os.path.abspath(db_path))[0] + "_uploads"
+
+
+def zipf_weights(n, skew):
+    """Cumulative weights so rank 1 is picked ~2^skew times as often as rank 2, and so on."""
+    return list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+def chunks(rows, size):
+    it = iter(rows)
+    while batch := list(itertools.islice(it, size)):
+        yield batch
+
+
+def bulk_insert(db, sql, rows, batch):
+    count = 0
+    for part in chunks(rows, batch):
+        db.executemany(sql, part)
+        count += len(part)
+    return count
+
+
+def caption(rng):
+    return " ".join(rng.choices(WORDS, k=rng.randint(2, 8))).capitalize() + rng.choice(("", "!", " #harnect", " ✨"))
+
+
+def make_images(app, media, db, count, rng):
+    """Write `count` small placeholder JPEGs (plus their derivatives) into the upload folder."""
+    from PIL import Image, ImageDraw
+
+    names = []
+    for i in range(count):
+        img = Image.new("RGB", (1080, rng.choice((1080, 1350, 810))), tuple(rng.randint(40, 220) for _ in range(3)))
+        ImageDraw.Draw(img).text((40, 40), f"HARNECT seed #{i}", fill=(255, 255, 255))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=80)
+        data = buf.getvalue()
+        name = f"{hashlib.sha256(data).hexdigest()}.jpg"
+        path = os.path.join(app.config["UPLOAD_FOLDER"], name)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(data)
+        width, height, widths = media.make_image_variants(path, app.config["UPLOAD_FOLDER"])
+        db.execute("""INSERT OR REPLACE INTO media (filename, kind, status, width, height, variants, created_at)
+                      VALUES (?, 'image', 'ready', ?, ?, ?, ?)""", (name, width, height, ",".join(map(str, widths)), datetime.utcnow().isoformat()))
+        db.execute("""INSERT INTO blobs (filename, sha256, size, refcount, created_at) VALUES (?,?,?,0,?)
+                      ON CONFLICT(filename) DO NOTHING""", (name, name.split(".")[0], len(data), datetime.utcnow().isoformat()))
+        names.append(name)
+    return names
+
+
+def main():
+    args = parse_args()
+    os.environ["HARNECT_DATABASE"] = os.path.abspath(args.db)
+    # Placeholder images stay out of static/uploads, which belongs to harnect.db.
+    os.environ.setdefault("HARNECT_UPLOAD_FOLDER", seed_upload_folder(args.db))
+    os.environ.setdefault("HARNECT_MAINTENANCE_MODE", "external")
+    os.environ.setdefault("HARNECT_VIDEO_WORKER_MODE", "external")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as harnect  # migrates the target database on import
+    import media
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    db = harnect.connect_db(isolation_level=None)
+    db.execute("BEGIN IMMEDIATE")
+
+    # ---------------------------
+    # Users: rank 0 is the most popular account
+    # ---------------------------
+    run = rng.randrange(16 ** 6)
+    users = [f"user{run:06x}_{i}" for i in range(args.users)]
+    guests = [f"Guest_seed{run:06x}_{i}" for i in range(args.guests)]
+    password = generate_password_hash("password")  # one hash for everyone; hashing is deliberately slow
+    bulk_insert(db, "INSERT INTO users (username, password_hash, bio, email, guest, created_at) VALUES (?,?,?,?,?,?)",
+                ((u, password, caption(rng), f"{u}@example.com", 0, (now - timedelta(days=args.days + rng.random() * 30)).isoformat()) for u in users),
+                args.batch)
+    bulk_insert(db, "INSERT INTO users (username, password_hash, bio, profile_pic, guest, created_at) VALUES (?,?,?,?,?,?)",
+                ((u, None, "I am a guest user.", "user.png", 1, (now - timedelta(days=rng.random() * 10)).isoformat()) for u in guests),
+                args.batch)
+    popularity = zipf_weights(len(users), args.skew)
+    pick_user = lambda: rng.choices(users, cum_weights=popularity)[0]
+    print(f"users:    {len(users) + len(guests)}")
+
+    # ---------------------------
+    # Posts and stories (popular accounts post more)
+    # ---------------------------
+    images = make_images(harnect.app, media, db, args.images, rng)
+    refs = {name: 0 for name in images}
+
+    def post_rows(count, kind, max_age):
+        rows = []
+        for _ in range(count):
+            image = rng.choice(images)
+            refs[image] += 1
+            age = max_age * rng.random() ** 2  # denser towards now
+            rows.append((pick_user(), image, caption(rng), kind, (now - age).isoformat()))
+        return sorted(rows, key=lambda r: r[4])  # ids ascend with time, as they do in production
+
+    insert_post = "INSERT INTO posts (username, filename, caption, type, created_at) VALUES (?,?,?,?,?)"
+    last_id = db.execute("SELECT COALESCE(MAX(id), 0) FROM posts").fetchone()[0]
+    bulk_insert(db, insert_post, post_rows(args.posts, "post", timedelta(days=args.days)), args.batch)
+    bulk_insert(db, insert_post, post_rows(args.stories, "story", timedelta(hours=23)), args.batch)
+    post_ids = [r[0] for r in db.execute("SELECT id FROM posts WHERE id>? AND type='post' ORDER BY id", (last_id,))]
+    db.executemany("UPDATE blobs SET refcount=refcount+?, released_at=NULL WHERE filename=?", [(n, name) for name, n in refs.items()])
+    print(f"posts:    {args.posts} (+{args.stories} stories)")
+
+    # ---------------------------
+    # Follows: followers concentrate on popular accounts
+    # ---------------------------
+    def follow_rows():
+        seen = set()
+        for _ in range(args.follows * 3):
+            if len(seen) >= args.follows:
+                break
+            pair = (pick_user(), rng.choice(users))
+            if pair[0] != pair[1] and pair not in seen:
+                seen.add(pair)
+                yield (*pair, (now - timedelta(days=rng.random() * args.days)).isoformat())
+
+    follows = bulk_insert(db, "INSERT OR IGNORE INTO followers (username, follower, created_at) VALUES (?,?,?)", follow_rows(), args.batch)
+    print(f"follows:  {follows}")
+
+    # ---------------------------
+    # Likes and comments: skewed towards recent posts
+    # ---------------------------
+    recency = zipf_weights(len(post_ids), max(args.skew - 0.3, 0)) if post_ids else []
+    by_recency = post_ids[::-1]
+
+    def engagement_rows(count, unique):
+        seen = set()
+        for _ in range(count * (3 if unique else 1)):
+            if len(seen) >= count:
+                break
+            key = (rng.choices(by_recency, cum_weights=recency)[0], rng.choice(users))
+            if unique and key in seen:
+                continue
+            seen.add(key)
+            yield key
+
+    if post_ids:
+        likes = bulk_insert(db, "INSERT OR IGNORE INTO likes (post_id, username, created_at) VALUES (?,?,?)",
+                            ((p, u, now.isoformat()) for p, u in engagement_rows(args.likes, True)), args.batch)
+        comments = bulk_insert(db, "INSERT INTO comments (post_id, username, text, created_at) VALUES (?,?,?,?)",
+                               ((p, u, caption(rng), (now - timedelta(minutes=rng.random() * 60 * 24 * 30)).isoformat())
+                                for p, u in engagement_rows(args.comments, False)), args.batch)
+        print(f"likes:    {likes}\ncomments: {comments}")
+
+    # ---------------------------
+    # Derived data
+    # ---------------------------
+    harnect.backfill_counters(db)
+    harnect.rebuild_timelines(db)
+    db.execute("COMMIT")
+    db.execute("PRAGMA optimize")
+    db.close()
+    print(f"Seeded {args.db} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -204,10 +204,15 @@ function likePost(event, postId, btn) {
     btn.dataset.likeCount = likeCount;
     btn.textContent = `❤️ ${likeCount} Likes`;
 
-    // Send update to backend
-    fetch(`/like/${postId}`, { method: "POST" })
+    // Send the desired state rather than a toggle, so a replay from the offline queue is harmless
+    fetch(`/like/${postId}`, {
+        method: "POST",
+        headers: {'Content-Type': 'application/x-www-form-urlencoded'},
+        body: `liked=${isLiked ? 0 : 1}`
+    })
         .then(res => res.json())
         .then(data => {
+            if (data.queued) return;  // offline: the service worker sends it later
             // Sync just in case server differs
             btn.classList.toggle('liked', data.liked);
             btn.dataset.likeCount = data.like_count;
@@ -221,17 +226,72 @@ function likePost(event, postId, btn) {
             btn.textContent = `❤️ ${btn.dataset.likeCount} Likes`;
         });
 }
-setInterval(async () => {
-    const posts = document.querySelectorAll('.like-btn');
-    for (let btn of posts) {
-        const postId = btn.dataset.postId;
-        const res = await fetch(`/like-count/${postId}`);
-        const data = await res.json();
-        btn.dataset.likeCount = data.like_count;
-        btn.textContent = `❤️ ${data.like_count} Likes`;
-        btn.classList.toggle('liked', data.user_liked);
+
+// ================= LIVE COUNTS =================
+// One batched request resyncs every visible post; after that the server
+// pushes changes over SSE. Without SSE we fall back to batched polling.
+const COUNTS_POLL_MS = 30000;
+let countsSource = null;
+let countsPollTimer = null;
+
+function visiblePostIds() {
+    return [...document.querySelectorAll('.like-btn')].map(btn => btn.dataset.postId);
+}
+
+function setLikeCount(btn, count, liked) {
+    btn.dataset.likeCount = count;
+    btn.textContent = `❤️ ${count} Likes`;
+    if (liked !== undefined) btn.classList.toggle('liked', liked);
+}
+
+function applyCounts(data) {
+    const btn = document.querySelector(`.like-btn[data-post-id="${data.id}"]`);
+    if (btn && data.like_count !== undefined) setLikeCount(btn, data.like_count, data.liked);
+
+    const commentBtn = document.querySelector(`#post-${data.id} .comment-form button`);
+    if (commentBtn && data.comment_count !== undefined) {
+        commentBtn.dataset.commentCount = data.comment_count;
+        commentBtn.textContent = `💬 Comment (${data.comment_count})`;
     }
-}, 5000); // every 5 seconds
+}
+
+function syncLikeCounts() {
+    const ids = visiblePostIds();
+    if (!ids.length) return;
+
+    fetch(`/like-counts?ids=${ids.join(',')}`)
+        .then(res => res.json())
+        .then(counts => {
+            Object.entries(counts).forEach(([id, c]) => applyCounts({ id, ...c }));
+        })
+        .catch(err => console.error(err));
+}
+
+function connectLiveCounts() {
+    const ids = visiblePostIds();
+    const hasBadge = !!document.querySelector('.notif-badge');
+    if (countsSource) countsSource.close();
+    clearInterval(countsPollTimer);
+    if (!ids.length && !hasBadge) return;
+
+    if (!window.EventSource || document.body.dataset.liveCounts !== '1') {
+        if (ids.length) countsPollTimer = setInterval(syncLikeCounts, COUNTS_POLL_MS);
+        return;
+    }
+
+    // The same stream carries the unread notification count, so each tab
+    // holds one connection (browsers allow six per origin over HTTP/1.1).
+    countsSource = new EventSource(`/stream/counts?ids=${ids.join(',')}`);
+    countsSource.addEventListener('counts', e => applyCounts(JSON.parse(e.data)));
+    countsSource.addEventListener('notifications', e => setUnreadBadge(JSON.parse(e.data).unread));
+    // Catch up on anything missed while (re)connecting.
+    countsSource.addEventListener('open', () => {
+        syncLikeCounts();
+        if (hasBadge) refreshUnreadBadge();
+    });
+}
+
+document.addEventListener('DOMContentLoaded', connectLiveCounts);
 
 // ================= COMMENTS =================
 function submitComment(event, postId) {
@@ -241,15 +301,25 @@ function submitComment(event, postId) {
     const commentText = input.value.trim();
     if (!commentText) return;
 
+    const clientKey = window.crypto?.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`;
     fetch(`/comment/${postId}`, {
         method: 'POST',
         headers: {'Content-Type': 'application/x-www-form-urlencoded'},
-        body: `comment=${encodeURIComponent(commentText)}`
+        body: `comment=${encodeURIComponent(commentText)}&client_key=${encodeURIComponent(clientKey)}`
     })
     .then(res => res.json())
     .then(data => {
         // Clear input
         input.value = '';
+        if (data.queued) {
+            // Offline: shown as pending until the service worker replays it
+            const pending = document.createElement('div');
+            pending.className = 'comment pending';
+            pending.innerHTML = '<strong>You:</strong> <span class="comment-text"></span> <em>(will post when online)</em>';
+            pending.querySelector('.comment-text').textContent = commentText;
+            document.getElementById(`comments-${postId}`).appendChild(pending);
+            return;
+        }
 
         // Add new comment dynamically
          const commentsDiv = document.getElementById(`comments-${postId}`);
@@ -268,20 +338,214 @@ function submitComment(event, postId) {
           // Append to comments container
           commentsDiv.appendChild(div);
 
-          // Attach event listeners
-         div.querySelector('.edit-btn').addEventListener('click', () => editComment(data.id));
-         div.querySelector('.delete-btn').addEventListener('click', () => deleteComment(data.id, `comment-${data.id}`));
-
-          // Update comment count
-         const commentBtn = form.querySelector('button');
-         const count = commentsDiv.querySelectorAll('.comment').length;
-         commentBtn.textContent = `💬 Comment (${count})`;
+          // Set the server's total rather than adding 1: the live-counts event may already have applied it
+         applyCounts({ id: postId, comment_count: data.comment_count });
         })
         .catch(err => console.error(err));
       }
 
 
 
+// ================= LOAD OLDER COMMENTS =================
+function buildComment(c) {
+    const div = document.createElement('div');
+    div.className = 'comment';
+    div.id = `comment-${c.id}`;
+
+    const name = document.createElement('strong');
+    name.textContent = `@${c.username}:`;
+    const text = document.createElement('span');
+    text.className = 'comment-text';
+    text.textContent = c.text;
+    div.append(name, ' ', text);
+
+    if (c.own) {
+        const edit = document.createElement('button');
+        edit.textContent = '✏️';
+        edit.onclick = () => editComment(c.id);
+        const del = document.createElement('button');
+        del.textContent = '🗑️';
+        del.onclick = () => deleteComment(c.id);
+        div.append(' ', edit, ' ', del);
+    }
+    return div;
+}
+
+function loadMoreComments(postId, btn) {
+    btn.disabled = true;
+    fetch(`/comments/${postId}?before=${encodeURIComponent(btn.dataset.before)}`)
+        .then(res => res.json())
+        .then(data => {
+            const frag = document.createDocumentFragment();
+            data.comments.forEach(c => frag.appendChild(buildComment(c)));
+            btn.after(frag);
+            if (data.next_cursor) {
+                btn.dataset.before = data.next_cursor;
+                btn.disabled = false;
+            } else {
+                btn.remove();
+            }
+        })
+        .catch(err => {
+            console.error(err);
+            btn.disabled = false;
+        });
+}
+
+
+// ================= INFINITE SCROLL FEED =================
+function loadNextFeedPage(sentinel, observer) {
+    if (sentinel.dataset.loading) return;
+    sentinel.dataset.loading = '1';
+
+    fetch(`/index?partial=1&cursor=${encodeURIComponent(sentinel.dataset.nextCursor)}`)
+        .then(res => res.text())
+        .then(html => {
+            const tpl = document.createElement('template');
+            tpl.innerHTML = html;
+            observer.unobserve(sentinel);
+            sentinel.replaceWith(tpl.content);
+            const next = document.querySelector('.feed-sentinel');
+            if (next) observer.observe(next);
+            connectLiveCounts();
+            pollProcessingMedia();
+        })
+        .catch(err => {
+            console.error(err);
+            delete sentinel.dataset.loading;
+        });
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    const sentinel = document.querySelector('.feed-sentinel');
+    if (!sentinel || !('IntersectionObserver' in window)) return;
+
+    const observer = new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (entry.isIntersecting) loadNextFeedPage(entry.target, observer);
+        });
+    }, { rootMargin: '600px 0px' });
+    observer.observe(sentinel);
+});
+
+
+// ================= VIDEO PROCESSING STATUS =================
+// Freshly uploaded videos render as a placeholder until the transcode job finishes.
+function pollProcessingMedia() {
+    document.querySelectorAll('.media-processing:not([data-polling])').forEach(el => {
+        el.dataset.polling = '1';
+        const check = () => {
+            fetch(`/post/${el.dataset.postId}/status`)
+                .then(res => res.json())
+                .then(data => {
+                    if (data.status === 'pending') return setTimeout(check, 4000);
+                    if (!data.src) return el.remove();
+
+                    const video = document.createElement('video');
+                    video.controls = true;
+                    video.playsInline = true;
+                    video.preload = 'none';
+                    if (data.poster) video.poster = data.poster;
+                    video.src = data.src;
+                    el.replaceWith(video);
+                })
+                .catch(() => setTimeout(check, 10000));
+        };
+        setTimeout(check, 4000);
+    });
+}
+
+document.addEventListener('DOMContentLoaded', pollProcessingMedia);
+
+
+// ================= CHUNKED UPLOADS =================
+// Files above the form's data-chunked-over size go up in checksummed chunks
+// through an upload session. The session id is remembered per file, so a
+// retry after a dropped connection resumes from the server's offset.
+async function sha256Hex(blob) {
+    if (!window.crypto?.subtle) return null;
+    const hash = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(hash), b => b.toString(16).padStart(2, '0')).join('');
+}
+
+async function resumeOrStartSession(file, form, key) {
+    const saved = localStorage.getItem(key);
+    if (saved) {
+        const res = await fetch(`/upload/session/${saved}`);
+        if (res.ok) return res.json();
+        localStorage.removeItem(key);
+    }
+    const res = await fetch('/upload/session', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            filename: file.name,
+            size: file.size,
+            caption: form.querySelector('[name=caption]')?.value || '',
+            type: form.querySelector('[name=type]')?.value || 'post'
+        })
+    });
+    const data = await res.json();
+    if (!res.ok) throw new Error(data.error || 'Could not start upload');
+    localStorage.setItem(key, data.id);
+    return data;
+}
+
+async function chunkedUpload(file, form, onProgress) {
+    const key = `harnect-upload:${file.name}:${file.size}:${file.lastModified}`;
+    const info = await resumeOrStartSession(file, form, key);
+    let offset = info.offset;
+    let failures = 0;
+
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + info.chunk_size);
+        const headers = {};
+        const digest = await sha256Hex(chunk);
+        if (digest) headers['X-Chunk-SHA256'] = digest;
+        try {
+            const res = await fetch(`/upload/session/${info.id}?offset=${offset}`, { method: 'PUT', headers, body: chunk });
+            const data = await res.json();
+            if (res.ok || res.status === 409) {
+                offset = data.offset;
+                failures = 0;
+                onProgress(offset / file.size);
+                continue;
+            }
+            if (res.status !== 400) throw new Error(data.error || 'Upload failed');
+        } catch (err) {
+            if (!navigator.onLine) await new Promise(r => window.addEventListener('online', r, { once: true }));
+        }
+        if (++failures > 5) throw new Error('Upload keeps failing; try again later.');
+        await new Promise(r => setTimeout(r, 1000 * 2 ** failures));
+    }
+
+    const res = await fetch(`/upload/session/${info.id}/complete`, { method: 'POST' });
+    const data = await res.json();
+    if (!res.ok) throw new Error(data.error || 'Upload failed');
+    localStorage.removeItem(key);
+    return data;
+}
+
+document.querySelectorAll('.upload-form[data-chunked-over]').forEach(form => {
+    form.addEventListener('submit', event => {
+        const file = form.querySelector('input[type=file]')?.files[0];
+        if (!file || file.size <= Number(form.dataset.chunkedOver)) return;
+
+        event.preventDefault();
+        const btn = form.querySelector('button[type=submit]');
+        const label = btn.textContent;
+        btn.disabled = true;
+        chunkedUpload(file, form, p => { btn.textContent = `Uploading… ${Math.floor(p * 100)}%`; })
+            .then(data => { window.location.href = data.redirect; })
+            .catch(err => {
+                alert(err.message);
+                btn.disabled = false;
+                btn.textContent = label;
+            });
+    });
+});
+
+
 // ================= DELETE POST =================
 function deletePost(postId, postElementId) {
     if (!confirm("Are you sure you want to delete this post?")) return;
@@ -407,6 +671,32 @@ document.querySelectorAll(".explore-item").forEach(item => {
   item.style.animation = "fadeSlideUp .35s ease";
 });
 
+/* EXPLORE SEARCH AUTOCOMPLETE */
+const searchInput = document.getElementById("searchInput");
+if (searchInput) {
+  const suggestions = document.getElementById("searchSuggestions");
+  let suggestTimer = null;
+
+  searchInput.addEventListener("input", () => {
+    clearTimeout(suggestTimer);
+    const q = searchInput.value.trim();
+    if (!q) return;
+
+    suggestTimer = setTimeout(() => {
+      fetch(`/search/suggest?q=${encodeURIComponent(q)}`)
+        .then(res => res.json())
+        .then(users => {
+          suggestions.replaceChildren(...users.map(u => {
+            const opt = document.createElement("option");
+            opt.value = u.username;
+            return opt;
+          }));
+        })
+        .catch(err => console.error(err));
+    }, 200);
+  });
+}
+
 /*edit and delete comment*/
 
 function deleteComment(commentId) {
@@ -481,3 +771,62 @@ document.addEventListener("DOMContentLoaded", () => {
     });
   }
 });
+
+
+// ================= NOTIFICATIONS BADGE =================
+// The unread count comes from one cheap request, then from "notifications"
+// events on the live-counts stream (see connectLiveCounts). Polls if SSE is off.
+const NOTIFICATIONS_POLL_MS = 60000;
+
+function setUnreadBadge(count) {
+    document.querySelectorAll('.notif-badge').forEach(badge => {
+        badge.textContent = count > 99 ? '99+' : count;
+        badge.hidden = !count;
+    });
+}
+
+function refreshUnreadBadge() {
+    fetch('/notifications/count')
+        .then(res => res.json())
+        .then(data => setUnreadBadge(data.unread))
+        .catch(() => {});
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    if (!document.querySelector('.notif-badge')) return;
+    refreshUnreadBadge();
+    if (!window.EventSource || document.body.dataset.liveCounts !== '1') {
+        setInterval(refreshUnreadBadge, NOTIFICATIONS_POLL_MS);
+    }
+});
+
+
+// ================= SERVICE WORKER =================
+// Registered from the root so it controls every page. It queues likes and
+// comments made offline; browsers without Background Sync ask it to replay
+// the queue when the connection comes back.
+if ('serviceWorker' in navigator) {
+    window.addEventListener('load', () => {
+        navigator.serviceWorker.register('/service-worker.js', { scope: '/' })
+            .catch(err => console.error('Service worker registration failed', err));
+    });
+
+    const replayOutbox = () => navigator.serviceWorker.controller?.postMessage({ type: 'replay-outbox' });
+    window.addEventListener('online', replayOutbox);
+    navigator.serviceWorker.ready.then(replayOutbox);
+
+    navigator.serviceWorker.addEventListener('message', event => {
+        const msg = event.data || {};
+        if (msg.type === 'outbox-flushed') {
+            syncLikeCounts();
+        } else if (msg.type === 'page-updated' && msg.url === location.href && !document.getElementById('page-updated')) {
+            // The page came from the cache and a newer copy has arrived.
+            const bar = document.createElement('button');
+            bar.id = 'page-updated';
+            bar.className = 'page-updated';
+            bar.textContent = 'New posts available — tap to refresh';
+            bar.addEventListener('click', () => location.reload());
+            document.body.prepend(bar);
+        }
+    });
+}
@@ -1,43 +1,269 @@
 // ================= CACHE CONFIGURATION =================
-const CACHE_NAME = 'harnect-cache-v1';
+// Served by the /service-worker.js route, which fills in ASSET_VERSION (a hash
+// of static/ and templates/). A deploy therefore installs a new worker whose
+// static and page caches start empty; hashed uploads never change and keep
+// their cache across versions.
+const ASSET_VERSION = '__ASSET_VERSION__';
+const STATIC_CACHE = `harnect-static-${ASSET_VERSION}`;
+const PAGES_CACHE = `harnect-pages-${ASSET_VERSION}`;
+const MEDIA_CACHE = 'harnect-media';
+const API_CACHE = 'harnect-api';
 const APP_SHELL = [
-  '/',
   '/static/style.css',
   '/static/script.js',
-];
+  '/static/manifest.json',
+  '/static/icons/icon-192.png',
+].map((url) => `${url}?v=${ASSET_VERSION}`);
+
+// LRU limits, by entry count and by bytes, so the caches cannot fill the device.
+const LIMITS = {
+  [MEDIA_CACHE]: { entries: 300, bytes: 80 * 1024 * 1024 },
+  [API_CACHE]: { entries: 100, bytes: 5 * 1024 * 1024 },
+  [PAGES_CACHE]: { entries: 30, bytes: 10 * 1024 * 1024 },
+};
+const MEDIA_MAX_ENTRY_BYTES = 10 * 1024 * 1024;  // larger files (videos) stay network-only
+
+// <sha256>.<ext> or a derivative like <sha256>_w320.webp (see CONTENT_NAME in app.py)
+const HASHED_UPLOAD = /^\/uploads\/[0-9a-f]{64}(?:_[a-z0-9]+)?\.[a-z0-9]+$/;
+const SWR_PAGES = [/^\/index$/, /^\/profile\/[^/]+$/];
+const QUEUEABLE = /^\/(like|comment)\/\d+$/;
+const AUTH_PATHS = ['/login', '/signup', '/guest', '/logout'];
+
+
+// ================= INDEXEDDB =================
+// "outbox": likes/comments made offline, replayed in order.
+// "lru": url -> {cache, size, lastUsed} for the bounded caches.
+function openDb() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open('harnect-sw', 1);
+    req.onupgradeneeded = () => {
+      req.result.createObjectStore('outbox', { keyPath: 'id', autoIncrement: true });
+      req.result.createObjectStore('lru', { keyPath: 'url' });
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function idb(store, mode, fn) {
+  const db = await openDb();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(store, mode);
+    const req = fn(tx.objectStore(store));
+    tx.oncomplete = () => resolve(req && req.result);
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+
+// ================= BOUNDED CACHES =================
+// Record a use of `url`; without `size` only the timestamp of an existing entry moves.
+async function touch(cacheName, url, size) {
+  await idb('lru', 'readwrite', (s) => {
+    if (size !== undefined) return s.put({ url, cache: cacheName, size, lastUsed: Date.now() });
+    const req = s.get(url);
+    req.onsuccess = () => req.result && s.put({ ...req.result, lastUsed: Date.now() });
+    return req;
+  });
+}
+
+async function trim(cacheName) {
+  const limit = LIMITS[cacheName];
+  const entries = (await idb('lru', 'readonly', (s) => s.getAll()))
+    .filter((e) => e.cache === cacheName)
+    .sort((a, b) => b.lastUsed - a.lastUsed);
+  let bytes = 0;
+  const evict = entries.filter((e, i) => (bytes += e.size) > limit.bytes || i >= limit.entries);
+  if (!evict.length) return;
+  const cache = await caches.open(cacheName);
+  await Promise.all(evict.map((e) => cache.delete(e.url)));
+  await idb('lru', 'readwrite', (s) => evict.forEach((e) => s.delete(e.url)));
+}
+
+async function store(cacheName, request, response) {
+  const size = Number(response.headers.get('Content-Length')) || (await response.clone().blob()).size;
+  if (cacheName === MEDIA_CACHE && size > MEDIA_MAX_ENTRY_BYTES) return;
+  await (await caches.open(cacheName)).put(request, response);
+  await touch(cacheName, request.url, size);
+  await trim(cacheName);
+}
+
+function cacheable(response) {
+  return response.ok && response.status === 200 && !response.redirected &&
+    !/no-store/.test(response.headers.get('Cache-Control') || '');
+}
+
+
+// ================= STRATEGIES =================
+function offline(request) {
+  if (request.mode === 'navigate') {
+    return new Response(
+      '<!doctype html><meta name="viewport" content="width=device-width"><title>Offline</title>' +
+      '<p style="font-family:sans-serif;text-align:center;margin-top:30vh">You are offline. ' +
+      '<a href="javascript:location.reload()">Retry</a></p>',
+      { status: 503, headers: { 'Content-Type': 'text/html; charset=utf-8' } });
+  }
+  return new Response(JSON.stringify({ error: 'offline' }),
+    { status: 503, headers: { 'Content-Type': 'application/json' } });
+}
+
+// Hashed uploads and versioned static files never change: serve from cache.
+async function cacheFirst(event, cacheName) {
+  const cached = await caches.match(event.request, { cacheName });
+  if (cached) {
+    if (LIMITS[cacheName]) event.waitUntil(touch(cacheName, event.request.url));
+    return cached;
+  }
+  try {
+    const response = await fetch(event.request);
+    if (cacheable(response)) {
+      const copy = response.clone();
+      event.waitUntil(LIMITS[cacheName]
+        ? store(cacheName, event.request, copy)
+        : caches.open(cacheName).then((c) => c.put(event.request, copy)));
+    }
+    return response;
+  } catch (err) {
+    return offline(event.request);
+  }
+}
+
+// Feed and profile pages: answer instantly from cache, refresh in the
+// background, and tell the page when the fresh copy differs.
+async function staleWhileRevalidate(event) {
+  const cached = await caches.match(event.request, { cacheName: PAGES_CACHE });
+  const previous = cached && cached.clone().text();
+  const refresh = fetch(event.request).then((response) => {
+    if (cacheable(response)) event.waitUntil(updatePage(event, response.clone(), previous));
+    return response;
+  });
+  if (cached) {
+    event.waitUntil(refresh.catch(() => {}));
+    return cached;
+  }
+  return refresh.catch(() => offline(event.request));
+}
+
+async function updatePage(event, response, previous) {
+  const fresh = await response.clone().text();
+  await store(PAGES_CACHE, event.request, response);
+  if (previous && fresh !== await previous) {
+    const client = await self.clients.get(event.resultingClientId || event.clientId);
+    if (client) client.postMessage({ type: 'page-updated', url: event.request.url });
+  }
+}
+
+// APIs, partial pages and everything else: network, falling back to the last copy.
+async function networkFirst(event, cacheName) {
+  try {
+    const response = await fetch(event.request);
+    if (cacheName && cacheable(response)) event.waitUntil(store(cacheName, event.request, response.clone()));
+    return response;
+  } catch (err) {
+    return (await caches.match(event.request, cacheName ? { cacheName } : undefined)) || offline(event.request);
+  }
+}
+
+
+// ================= OFFLINE ACTION QUEUE =================
+// The page sends likes with an explicit liked=0/1 and comments with a
+// client_key, so replaying a request the server already applied is harmless.
+async function queueOrSend(event) {
+  const body = await event.request.clone().text();
+  try {
+    return await fetch(event.request);
+  } catch (err) {
+    await idb('outbox', 'readwrite', (s) => s.add({
+      url: event.request.url,
+      body,
+      contentType: event.request.headers.get('Content-Type'),
+      queuedAt: Date.now(),
+    }));
+    if (self.registration.sync) await self.registration.sync.register('harnect-outbox').catch(() => {});
+    return new Response(JSON.stringify({ queued: true }),
+      { status: 202, headers: { 'Content-Type': 'application/json' } });
+  }
+}
+
+async function replayOutbox() {
+  const items = await idb('outbox', 'readonly', (s) => s.getAll());
+  for (const item of items) {
+    const response = await fetch(item.url, {
+      method: 'POST',
+      body: item.body,
+      headers: item.contentType ? { 'Content-Type': item.contentType } : {},
+      credentials: 'same-origin',
+    });  // a network error rejects, so the sync is retried later
+    if (response.status >= 500) throw new Error(`Replay failed with ${response.status}`);
+    // 2xx is done; 4xx (post deleted, logged out) will never succeed, so drop it too.
+    await idb('outbox', 'readwrite', (s) => s.delete(item.id));
+  }
+  const clients = await self.clients.matchAll();
+  if (items.length) clients.forEach((c) => c.postMessage({ type: 'outbox-flushed', count: items.length }));
+}
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === 'harnect-outbox') event.waitUntil(replayOutbox());
+});
+
+// Browsers without Background Sync ask for a replay when they come back online.
+self.addEventListener('message', (event) => {
+  if (event.data && event.data.type === 'replay-outbox') event.waitUntil(replayOutbox().catch(() => {}));
+});
 
 
 // ================= INSTALL EVENT =================
 self.addEventListener('install', (event) => {
   event.waitUntil(
-    caches.open(CACHE_NAME).then((cache) => {
-      return cache.addAll(APP_SHELL);
-    })
+    caches.open(STATIC_CACHE)
+      .then((cache) => cache.addAll(APP_SHELL))
+      .then(() => self.skipWaiting())
   );
 });
 
 
 // ================= ACTIVATE EVENT =================
 self.addEventListener('activate', (event) => {
+  const keep = [STATIC_CACHE, PAGES_CACHE, MEDIA_CACHE, API_CACHE];
   event.waitUntil(
-    caches.keys().then((keys) =>
-      Promise.all(
-        keys.map((key) => {
-          if (key !== CACHE_NAME) return caches.delete(key);
-        })
-      )
-    )
+    caches.keys()
+      .then((keys) => Promise.all(keys.filter((key) => !keep.includes(key)).map((key) => caches.delete(key))))
+      .then(() => idb('lru', 'readwrite', (s) => s.getAll()).then(async (entries) => {
+        const stale = entries.filter((e) => !keep.includes(e.cache));
+        if (stale.length) await idb('lru', 'readwrite', (s) => stale.forEach((e) => s.delete(e.url)));
+      }))
+      .then(() => self.clients.claim())
   );
 });
 
 
 // ================= FETCH EVENT =================
 self.addEventListener('fetch', (event) => {
-  event.respondWith(
-    caches.match(event.request).then((cached) => {
-      if (cached) return cached;
-      return fetch(event.request).catch(() => {
-      });
-    })
-  );
+  const request = event.request;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) return;
+
+  // Signing in or out switches user: drop everything cached for the previous one.
+  if (AUTH_PATHS.includes(url.pathname)) {
+    event.waitUntil(Promise.all([caches.delete(PAGES_CACHE), caches.delete(API_CACHE)]));
+    return;
+  }
+  if (request.method === 'POST' && QUEUEABLE.test(url.pathname)) {
+    event.respondWith(queueOrSend(event));
+    return;
+  }
+  if (request.method !== 'GET' || request.headers.has('Range')) return;
+  if (url.pathname.startsWith('/stream/') || url.pathname === '/metrics' || url.pathname === '/service-worker.js') return;
+
+  if (HASHED_UPLOAD.test(url.pathname)) {
+    event.respondWith(cacheFirst(event, MEDIA_CACHE));
+  } else if (url.pathname.startsWith('/static/') && url.searchParams.get('v') === ASSET_VERSION) {
+    event.respondWith(cacheFirst(event, STATIC_CACHE));
+  } else if (request.mode === 'navigate' && !url.search && SWR_PAGES.some((re) => re.test(url.pathname))) {
+    event.respondWith(staleWhileRevalidate(event));
+  } else if (request.mode === 'navigate') {
+    event.respondWith(networkFirst(event, null));
+  } else {
+    event.respondWith(networkFirst(event, API_CACHE));
+  }
 });